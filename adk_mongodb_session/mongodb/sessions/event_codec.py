@@ -0,0 +1,68 @@
+import pickle
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from google.adk.events.event_actions import EventActions
+
+VERSION_KEY = "_v"
+
+
+class EventCodec(ABC):
+    """Encodes EventActions into a value stored on the event document."""
+
+    version: int = 0
+
+    @abstractmethod
+    def encode_actions(self, actions: Optional[EventActions]) -> Any:
+        ...
+
+    @abstractmethod
+    def decode_actions(self, stored: Any) -> EventActions:
+        ...
+
+
+class JsonEventCodec(EventCodec):
+    """Schema-based encoding of EventActions as a BSON sub-document.
+
+    Only non-default fields are written, so a typical event stores a small
+    ``state_delta`` and nothing else. Documents written by the legacy pickle
+    format are rejected unless ``allow_pickle`` is true, which only the
+    migration that rewrites them should set: unpickling stored data can run
+    arbitrary code.
+    """
+
+    version = 1
+
+    def __init__(self, allow_pickle: bool = False):
+        self.allow_pickle = allow_pickle
+
+    def encode_actions(self, actions: Optional[EventActions]) -> Any:
+        data = (
+            actions.model_dump(mode="json", exclude_defaults=True)
+            if actions
+            else {}
+        )
+        data[VERSION_KEY] = self.version
+        return data
+
+    def decode_actions(self, stored: Any) -> EventActions:
+        if stored is None:
+            return EventActions()
+        if isinstance(stored, (bytes, bytearray)):
+            return self._decode_pickle(stored)
+        if not isinstance(stored, dict):
+            raise ValueError(f"Unsupported stored actions type: {type(stored)!r}")
+
+        version = stored.get(VERSION_KEY)
+        if version != self.version:
+            raise ValueError(f"Unsupported event actions version: {version!r}")
+
+        payload = {k: v for k, v in stored.items() if k != VERSION_KEY}
+        return EventActions.model_validate(payload)
+
+    def _decode_pickle(self, stored: bytes) -> EventActions:
+        if not self.allow_pickle:
+            raise ValueError(
+                "Pickled event actions are not allowed; run migrate_pickled_events."
+            )
+        return pickle.loads(stored)
@@ -0,0 +1,26 @@
+from typing import Any, Mapping
+
+from google.adk.sessions.state import State
+
+
+class LayeredState(dict):
+    """A session state view over the app, user and session state layers.
+
+    The view is built with a single shallow merge: values are shared with
+    the layers rather than deep-copied, so reading a large prompt string or
+    config dict costs nothing. Nested values are shared with the layers and
+    must be replaced, not mutated in place, which is also what ADK requires
+    for a state change to be recorded in an event's ``state_delta``.
+    """
+
+    def __init__(
+        self,
+        app_state: Mapping[str, Any],
+        user_state: Mapping[str, Any],
+        session_state: Mapping[str, Any],
+    ):
+        super().__init__(session_state)
+        for key, value in app_state.items():
+            super().__setitem__(State.APP_PREFIX + key, value)
+        for key, value in user_state.items():
+            super().__setitem__(State.USER_PREFIX + key, value)
@@ -1,10 +1,13 @@
-import copy
-import pickle
-from datetime import datetime
+import asyncio
+import inspect
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
 TAIPEI_TZ = ZoneInfo("Asia/Taipei")
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 
 from google.adk.events.event import Event
 from google.adk.sessions import _session_util
@@ -16,9 +19,16 @@ from google.adk.sessions.base_session_service import (
 from google.adk.sessions.session import Session
 from google.adk.sessions.state import State
 from google.genai import types
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 
+from .event_codec import EventCodec, JsonEventCodec
+from .layered_state import LayeredState
 from .mongodb_session import MongodbSession
+from .session_cache import CachedSession, SessionCache, copy_state
+from .session_lease import SessionLease, SessionLeaseManager, current_lease_token
+
+logger = logging.getLogger(__name__)
 
 
 def _extract_state_delta(state: dict[str, Any]):
@@ -36,23 +46,261 @@ def _extract_state_delta(state: dict[str, Any]):
     return app_state_delta, user_state_delta, session_state_delta
 
 
-def _merge_state(app_state, user_state, session_state):
-    merged_state = copy.deepcopy(session_state)
-    for key in app_state.keys():
-        merged_state[State.APP_PREFIX + key] = app_state[key]
-    for key in user_state.keys():
-        merged_state[State.USER_PREFIX + key] = user_state[key]
-    return merged_state
+def _state_update(
+    delta: dict[str, Any],
+    set_fields: Optional[dict[str, Any]] = None,
+    field: str = "state",
+) -> Any:
+    """Builds an update applying a state delta plus plain ``$set`` fields.
+
+    Keys are written as dotted ``state.<key>`` paths. MongoDB cannot address
+    keys containing '.' or starting with '$' that way, so a delta with such
+    keys becomes an update pipeline that applies each key with ``$setField``.
+    """
+    set_fields = set_fields or {}
+    if all("." not in key and not key.startswith("$") for key in delta):
+        update: dict[str, Any] = {
+            "$set": {
+                **{f"{field}.{key}": value for key, value in delta.items()},
+                **set_fields,
+            }
+        }
+        return update
+
+    state_expr: Any = {"$ifNull": [f"${field}", {}]}
+    for key, value in delta.items():
+        state_expr = {
+            "$setField": {
+                "field": {"$literal": key},
+                "input": state_expr,
+                "value": {"$literal": value},
+            }
+        }
+    stage = {field: state_expr}
+    stage.update({name: {"$literal": value} for name, value in set_fields.items()})
+    return [{"$set": stage}]
+
+
+def _now() -> datetime:
+    """Current time truncated to the millisecond precision MongoDB stores."""
+    now = datetime.now(TAIPEI_TZ)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _to_timestamp(value: Optional[datetime]) -> Optional[float]:
+    """Converts a stored datetime to a POSIX timestamp.
+
+    motor returns naive datetimes that are implicitly UTC.
+    """
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _trim_to_turn_start(events: list) -> list:
+    """Drops leading events so a truncated window starts at a user turn.
+
+    Accepts event documents or Event objects. This keeps a window from
+    opening with an orphaned tool call or response.
+    """
+    for index, event in enumerate(events):
+        author = event.get("author") if isinstance(event, dict) else event.author
+        if author == "user":
+            return events[index:]
+    return events
+
+
+def _build_session(
+    app_name: str,
+    user_id: str,
+    session_id: str,
+    state: LayeredState,
+    events: list[Event],
+    last_update_time: Optional[float],
+) -> MongodbSession:
+    session = MongodbSession(
+        app_name=app_name,
+        user_id=user_id,
+        id=session_id,
+        events=events,
+        last_update_time=last_update_time,
+    )
+    # Assigned after construction so pydantic keeps the view instead of
+    # copying it into a plain dict.
+    session.state = state
+    return session
+
+
+# Finished (or abandoned) delete job records expire this long after their
+# last update.
+DELETE_JOB_TTL_SECONDS = 7 * 24 * 3600
+
+
+@dataclass
+class DeleteSessionsJob:
+    """Progress of a background bulk session deletion."""
+
+    id: str
+    app_name: str
+    status: str = "running"
+    total: int = 0
+    deleted: int = 0
+    error: Optional[str] = None
 
 
 class MongodbSessionService(BaseSessionService):
-    def __init__(self, db_url: str, database: str, collection_prefix: str):
-        self.client = MongoClient(db_url)
+    """A session service backed by MongoDB through the async motor driver.
+
+    Pass an existing ``AsyncIOMotorClient`` as ``client`` to share its
+    connection pool (``db_url`` may then be None); otherwise a new client is
+    created from ``db_url``.
+    ``event_codec`` controls how EventActions are stored (see event_codec.py).
+
+    get_session loads the ``num_recent_events`` of its ``GetSessionConfig``,
+    or ``default_event_window`` recent events when none is given, with one
+    limited query on the (session_id, timestamp) index.
+
+    Sessions read without a ``GetSessionConfig``, or with only
+    ``num_recent_events``, go through ``session_cache``, which append_event
+    keeps current. A read without a config is served whatever window the
+    entry was loaded with, so a caller that loads a session with its own
+    window hands the same events to the Runner's later reads. A cached read
+    checks the stored ``update_time`` with a projected query, so writes from
+    other workers are seen, but the events and state are served from memory.
+    With ``SessionCache.revalidate_after`` set, entries validated within
+    that many seconds skip the check; this is safe when every turn holds the
+    session's lease, since taking over a lease from another worker drops the
+    cached entry.
+    Cached state is copied on the way in and out, so sessions never share
+    nested values with the cache.
+
+    When several workers share the database, callers serialize turns of a
+    session with ``acquire_session_lease`` / ``release_session_lease``.
+    While a lease is held, append_event stamps its fencing token on the
+    session and rejects writes from holders with an older token.
+    """
+
+    def __init__(
+        self,
+        db_url: Optional[str],
+        database: str,
+        collection_prefix: str,
+        *,
+        client: Optional[AsyncIOMotorClient] = None,
+        event_codec: Optional[EventCodec] = None,
+        default_event_window: Optional[int] = None,
+        session_cache: Optional[SessionCache] = None,
+        lease_ttl: float = 30.0,
+        lease_wait_timeout: float = 60.0,
+    ):
+        if client is None:
+            if not db_url:
+                raise ValueError("Either db_url or client must be provided.")
+            client = AsyncIOMotorClient(db_url)
+        self.client = client
         self.db = self.client[database]
         self.sessions_collection = self.db[f"{collection_prefix}_sessions"]
         self.app_states_collection = self.db[f"{collection_prefix}_app_states"]
         self.user_states_collection = self.db[f"{collection_prefix}_user_states"]
         self.events_collection = self.db[f"{collection_prefix}_events"]
+        self.delete_jobs_collection = self.db[f"{collection_prefix}_delete_jobs"]
+        self.event_codec = event_codec or JsonEventCodec()
+        self.default_event_window = default_event_window
+        self._background_tasks: set[asyncio.Task] = set()
+        self.session_cache = session_cache if session_cache is not None else SessionCache()
+        self.leases = SessionLeaseManager(
+            self.db[f"{collection_prefix}_session_leases"],
+            ttl=lease_ttl,
+            wait_timeout=lease_wait_timeout,
+        )
+
+    async def _load_app_user_state(
+        self, app_name: str, user_id: str
+    ) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Fetches the app and user state documents concurrently."""
+        app_state_doc, user_state_doc = await asyncio.gather(
+            self.app_states_collection.find_one({"_id": app_name}),
+            self.user_states_collection.find_one({"_id": f"{app_name}_{user_id}"}),
+        )
+        app_state = app_state_doc.get("state", {}) if app_state_doc else {}
+        user_state = user_state_doc.get("state", {}) if user_state_doc else {}
+        return app_state, user_state
+
+    async def ensure_indexes(self) -> None:
+        """Creates the indexes the session queries rely on."""
+        await asyncio.gather(
+            self.events_collection.create_index(
+                [("session_id", ASCENDING), ("timestamp", DESCENDING)]
+            ),
+            self.sessions_collection.create_index(
+                [("app_name", ASCENDING), ("user_id", ASCENDING)]
+            ),
+            self.delete_jobs_collection.create_index(
+                "updated_at", expireAfterSeconds=DELETE_JOB_TTL_SECONDS
+            ),
+        )
+
+    async def _load_event_docs(
+        self,
+        session_id: str,
+        num_recent_events: Optional[int],
+        after_timestamp: Optional[float],
+    ) -> list[dict]:
+        """Loads event documents in chronological order."""
+        query = {"session_id": session_id}
+        if after_timestamp:
+            after_dt = datetime.fromtimestamp(after_timestamp, TAIPEI_TZ)
+            query["timestamp"] = {"$gte": after_dt}
+        cursor = self.events_collection.find(query).sort("timestamp", -1)
+        if num_recent_events:
+            cursor = cursor.limit(num_recent_events)
+        docs = list(reversed(await cursor.to_list(length=None)))
+        if num_recent_events and len(docs) >= num_recent_events:
+            return _trim_to_turn_start(docs)
+        return docs
+
+    def _event_to_doc(self, session: Session, event: Event, now: datetime) -> dict:
+        return {
+            "_id": event.id,
+            "app_name": session.app_name,
+            "user_id": session.user_id,
+            "session_id": session.id,
+            "invocation_id": event.invocation_id,
+            "author": event.author,
+            "actions": self.event_codec.encode_actions(event.actions),
+            "branch": event.branch,
+            "timestamp": now,
+            "long_running_tool_ids": list(event.long_running_tool_ids if event.long_running_tool_ids else []),
+            "partial": event.partial,
+            "turn_complete": event.turn_complete,
+            "error_code": event.error_code,
+            "error_message": event.error_message,
+            "interrupted": event.interrupted,
+            "content": event.content.model_dump(exclude_none=True, mode="json") if event.content else None,
+            "grounding_metadata": event.grounding_metadata.model_dump(exclude_none=True, mode="json") if event.grounding_metadata else None,
+            "custom_metadata": event.custom_metadata,
+        }
+
+    def _doc_to_event(self, event_doc: dict) -> Event:
+        return Event(
+            id=event_doc.get("_id"),
+            invocation_id=event_doc.get("invocation_id"),
+            author=event_doc.get("author"),
+            actions=self.event_codec.decode_actions(event_doc.get("actions")),
+            branch=event_doc.get("branch"),
+            timestamp=_to_timestamp(event_doc.get("timestamp")),
+            long_running_tool_ids=set(event_doc.get("long_running_tool_ids", [])),
+            partial=event_doc.get("partial"),
+            turn_complete=event_doc.get("turn_complete"),
+            error_code=event_doc.get("error_code"),
+            error_message=event_doc.get("error_message"),
+            interrupted=event_doc.get("interrupted"),
+            content=_session_util.decode_model(event_doc.get("content"), types.Content),
+            grounding_metadata=_session_util.decode_model(event_doc.get("grounding_metadata"), types.GroundingMetadata),
+            custom_metadata=event_doc.get("custom_metadata"),
+        )
 
     async def create_session(
         self,
@@ -62,25 +310,19 @@ class MongodbSessionService(BaseSessionService):
         state: Optional[dict[str, Any]] = None,
         session_id: Optional[str] = None,
     ) -> Session:
-        app_state_doc = self.app_states_collection.find_one({"_id": app_name})
-        user_state_doc = self.user_states_collection.find_one(
-            {"_id": f"{app_name}_{user_id}"}
-        )
-
-        app_state = app_state_doc.get("state", {}) if app_state_doc else {}
-        user_state = user_state_doc.get("state", {}) if user_state_doc else {}
+        app_state, user_state = await self._load_app_user_state(app_name, user_id)
 
         app_state_delta, user_state_delta, session_state = _extract_state_delta(state)
 
         if app_state_delta:
             app_state.update(app_state_delta)
-            self.app_states_collection.update_one(
+            await self.app_states_collection.update_one(
                 {"_id": app_name}, {"$set": {"state": app_state}}, upsert=True
             )
 
         if user_state_delta:
             user_state.update(user_state_delta)
-            self.user_states_collection.update_one(
+            await self.user_states_collection.update_one(
                 {"_id": f"{app_name}_{user_id}"},
                 {"$set": {"state": user_state}},
                 upsert=True,
@@ -90,7 +332,7 @@ class MongodbSessionService(BaseSessionService):
             app_name=app_name, user_id=user_id, id=session_id
         )
 
-        now = datetime.now(TAIPEI_TZ)
+        now = _now()
         session_doc = {
             "_id": new_session.id,
             "app_name": app_name,
@@ -99,11 +341,21 @@ class MongodbSessionService(BaseSessionService):
             "create_time": now,
             "update_time": now,
         }
-        self.sessions_collection.insert_one(session_doc)
+        await self.sessions_collection.insert_one(session_doc)
 
-        merged_state = _merge_state(app_state, user_state, session_state)
-        new_session.state = merged_state
+        new_session.state = LayeredState(app_state, user_state, session_state)
         new_session.last_update_time = now.timestamp()
+        self.session_cache.put(
+            (app_name, user_id, new_session.id),
+            CachedSession(
+                app_state=copy_state(app_state),
+                user_state=copy_state(user_state),
+                session_state=copy_state(session_state),
+                events=[],
+                update_time=new_session.last_update_time,
+                event_window=self.default_event_window,
+            ),
+        )
         return new_session
 
     async def get_session(
@@ -114,158 +366,393 @@ class MongodbSessionService(BaseSessionService):
         session_id: str,
         config: Optional[GetSessionConfig] = None,
     ) -> Optional[Session]:
-        session_doc = self.sessions_collection.find_one(
-            {"_id": session_id, "app_name": app_name, "user_id": user_id}
+        cache_key = (app_name, user_id, session_id)
+        num_recent_events = config.num_recent_events if config else None
+        after_timestamp = config.after_timestamp if config else None
+        cacheable = not after_timestamp
+        if cacheable:
+            cached = await self._get_cached(cache_key)
+            if cached is not None and num_recent_events in (None, cached.event_window):
+                return self._session_from_cache(cache_key, cached)
+
+        if not num_recent_events:
+            num_recent_events = self.default_event_window
+
+        session_doc, (app_state, user_state), event_docs = await asyncio.gather(
+            self.sessions_collection.find_one(
+                {"_id": session_id, "app_name": app_name, "user_id": user_id}
+            ),
+            self._load_app_user_state(app_name, user_id),
+            self._load_event_docs(session_id, num_recent_events, after_timestamp),
         )
         if not session_doc:
             return None
 
-        app_state_doc = self.app_states_collection.find_one({"_id": app_name})
-        user_state_doc = self.user_states_collection.find_one(
-            {"_id": f"{app_name}_{user_id}"}
-        )
-
-        app_state = app_state_doc.get("state", {}) if app_state_doc else {}
-        user_state = user_state_doc.get("state", {}) if user_state_doc else {}
         session_state = session_doc.get("state", {})
+        events = [self._doc_to_event(event_doc) for event_doc in event_docs]
+
+        update_time = _to_timestamp(session_doc.get("update_time"))
+        if cacheable:
+            self.session_cache.put(
+                cache_key,
+                CachedSession(
+                    app_state=copy_state(app_state),
+                    user_state=copy_state(user_state),
+                    session_state=copy_state(session_state),
+                    events=list(events),
+                    update_time=update_time,
+                    event_window=num_recent_events,
+                ),
+            )
+        return _build_session(
+            app_name,
+            user_id,
+            session_id,
+            LayeredState(app_state, user_state, session_state),
+            events,
+            update_time,
+        )
 
-        merged_state = _merge_state(app_state, user_state, session_state)
+    async def _get_cached(self, key: tuple[str, str, str]) -> Optional[CachedSession]:
+        """Returns the cached entry if it still matches the stored update_time.
 
-        events = []
-        if config and config.after_timestamp:
-            after_dt = datetime.fromtimestamp(config.after_timestamp)
-            timestamp_filter = {"timestamp": {"$gte": after_dt}}
-        else:
-            timestamp_filter = {}
-
-        events_cursor = self.events_collection.find(
-            {"session_id": session_id, **timestamp_filter}
-        ).sort("timestamp", -1)
-
-        if config and config.num_recent_events:
-            events_cursor = events_cursor.limit(config.num_recent_events)
-
-        for event_doc in reversed(list(events_cursor)):
-            events.append(
-                Event(
-                    id=event_doc.get("_id"),
-                    invocation_id=event_doc.get("invocation_id"),
-                    author=event_doc.get("author"),
-                    actions=pickle.loads(event_doc.get("actions")),
-                    branch=event_doc.get("branch"),
-                    timestamp=event_doc.get("timestamp").timestamp(),
-                    long_running_tool_ids=set(event_doc.get("long_running_tool_ids", [])),
-                    partial=event_doc.get("partial"),
-                    turn_complete=event_doc.get("turn_complete"),
-                    error_code=event_doc.get("error_code"),
-                    error_message=event_doc.get("error_message"),
-                    interrupted=event_doc.get("interrupted"),
-                    content=_session_util.decode_model(event_doc.get("content"), types.Content),
-                    grounding_metadata=_session_util.decode_model(event_doc.get("grounding_metadata"), types.GroundingMetadata),
-                    custom_metadata=event_doc.get("custom_metadata"),
-                )
-            )
+        The check is skipped only for entries the cache reports as fresh,
+        which requires opting in through ``SessionCache.revalidate_after``.
+        """
+        entry = self.session_cache.get(key)
+        if entry is None:
+            return None
+        if self.session_cache.is_fresh(entry):
+            return entry
 
-        update_time = session_doc.get("update_time")
-        return MongodbSession(
-            app_name=app_name,
-            user_id=user_id,
-            id=session_id,
-            state=merged_state,
-            events=events,
-            last_update_time=update_time.timestamp() if update_time else None,
+        app_name, user_id, session_id = key
+        session_doc = await self.sessions_collection.find_one(
+            {"_id": session_id, "app_name": app_name, "user_id": user_id},
+            {"update_time": 1},
         )
+        if session_doc and _to_timestamp(session_doc.get("update_time")) == entry.update_time:
+            self.session_cache.mark_validated(entry)
+            return entry
+        self.session_cache.invalidate(key)
+        return None
+
+    def _session_from_cache(
+        self, key: tuple[str, str, str], entry: CachedSession
+    ) -> Session:
+        app_name, user_id, session_id = key
+        return _build_session(
+            app_name,
+            user_id,
+            session_id,
+            LayeredState(
+                copy_state(entry.app_state),
+                copy_state(entry.user_state),
+                copy_state(entry.session_state),
+            ),
+            list(entry.events),
+            entry.update_time,
+        )
+
+    def _update_cache_after_append(
+        self,
+        session: Session,
+        event: Event,
+        previous_update_time: Optional[float],
+        app_state_delta: dict[str, Any],
+        user_state_delta: dict[str, Any],
+        session_state_delta: dict[str, Any],
+    ) -> None:
+        """Applies a successful append to the cached entry of the session."""
+        key = (session.app_name, session.user_id, session.id)
+        if app_state_delta:
+            # App and user state are shared with other cached sessions.
+            self.session_cache.invalidate_where(session.app_name)
+            return
+        if user_state_delta:
+            self.session_cache.invalidate_where(session.app_name, session.user_id)
+            return
+
+        entry = self.session_cache.get(key)
+        if entry is None:
+            return
+        if entry.update_time != previous_update_time:
+            self.session_cache.invalidate(key)
+            return
+
+        entry.session_state.update(copy_state(session_state_delta))
+        entry.update_time = session.last_update_time
+        self.session_cache.mark_validated(entry)
+        events = entry.events + [event]
+        if entry.event_window and len(events) > entry.event_window:
+            events = _trim_to_turn_start(events[-entry.event_window:])
+        self.session_cache.replace_events(key, events)
 
     async def list_sessions(
-        self, *, app_name: str, user_id: str
+        self, *, app_name: str, user_id: str, include_events: bool = True
     ) -> ListSessionsResponse:
-        app_state_doc = self.app_states_collection.find_one({"_id": app_name})
-        user_state_doc = self.user_states_collection.find_one(
-            {"_id": f"{app_name}_{user_id}"}
+        """Lists the sessions of a user.
+
+        Session documents are fetched with one query. With ``include_events``
+        the events of all sessions are loaded by a single batched query and
+        bounded by the app's event window; without it, sessions come back with
+        an empty event list as in the other ADK session services.
+        """
+        (app_state, user_state), session_docs = await asyncio.gather(
+            self._load_app_user_state(app_name, user_id),
+            self.sessions_collection.find(
+                {"app_name": app_name, "user_id": user_id}
+            ).to_list(length=None),
         )
 
-        app_state = app_state_doc.get("state", {}) if app_state_doc else {}
-        user_state = user_state_doc.get("state", {}) if user_state_doc else {}
+        events_by_session: dict[str, list[Event]] = {}
+        if include_events and session_docs:
+            events_by_session = await self._load_events_for_sessions(
+                [doc["_id"] for doc in session_docs],
+                self.default_event_window,
+            )
 
         sessions = []
-        for session_doc in self.sessions_collection.find(
-            {"app_name": app_name, "user_id": user_id}
-        ):
-            session_state = session_doc.get("state", {})
-            merged_state = _merge_state(app_state, user_state, session_state)
-            update_time = session_doc.get("update_time")
-
-            events = []
-            for event_doc in self.events_collection.find(
-                {"session_id": session_doc.get("_id")}
-            ).sort("timestamp", 1):
-                events.append(
-                    Event(
-                        id=event_doc.get("_id"),
-                        invocation_id=event_doc.get("invocation_id"),
-                        author=event_doc.get("author"),
-                        actions=pickle.loads(event_doc.get("actions")),
-                        branch=event_doc.get("branch"),
-                        timestamp=event_doc.get("timestamp").timestamp(),
-                        long_running_tool_ids=set(event_doc.get("long_running_tool_ids", [])),
-                        partial=event_doc.get("partial"),
-                        turn_complete=event_doc.get("turn_complete"),
-                        error_code=event_doc.get("error_code"),
-                        error_message=event_doc.get("error_message"),
-                        interrupted=event_doc.get("interrupted"),
-                        content=_session_util.decode_model(event_doc.get("content"), types.Content),
-                        grounding_metadata=_session_util.decode_model(event_doc.get("grounding_metadata"), types.GroundingMetadata),
-                        custom_metadata=event_doc.get("custom_metadata"),
-                    )
-                )
+        for session_doc in session_docs:
             sessions.append(
-                MongodbSession(
-                    app_name=app_name,
-                    user_id=user_id,
-                    id=session_doc.get("_id"),
-                    state=merged_state,
-                    events=events,
-                    last_update_time=update_time.timestamp() if update_time else None,
+                _build_session(
+                    app_name,
+                    user_id,
+                    session_doc["_id"],
+                    LayeredState(app_state, user_state, session_doc.get("state", {})),
+                    events_by_session.get(session_doc["_id"], []),
+                    _to_timestamp(session_doc.get("update_time")),
                 )
             )
         return ListSessionsResponse(sessions=sessions)
 
+    async def _load_events_for_sessions(
+        self, session_ids: list[str], num_recent_events: Optional[int]
+    ) -> dict[str, list[Event]]:
+        """Loads the events of several sessions in one query.
+
+        With an event window, ``$setWindowFields`` ranks each session's events
+        from the newest and only the latest ``num_recent_events`` per session
+        leave the server. Documents are streamed and grouped here rather than
+        with ``$group``, so a long session never has to fit in one document.
+        """
+        query = {"session_id": {"$in": session_ids}}
+        if num_recent_events:
+            cursor = self.events_collection.aggregate(
+                [
+                    {"$match": query},
+                    {
+                        "$setWindowFields": {
+                            "partitionBy": "$session_id",
+                            "sortBy": {"timestamp": -1},
+                            "output": {"recent_rank": {"$documentNumber": {}}},
+                        }
+                    },
+                    {"$match": {"recent_rank": {"$lte": num_recent_events}}},
+                    {"$unset": "recent_rank"},
+                    {"$sort": {"session_id": 1, "timestamp": 1}},
+                ],
+                allowDiskUse=True,
+            )
+        else:
+            cursor = self.events_collection.find(query).sort(
+                [("session_id", ASCENDING), ("timestamp", ASCENDING)]
+            )
+
+        docs_by_session: dict[str, list[dict]] = {}
+        async for event_doc in cursor:
+            docs_by_session.setdefault(event_doc["session_id"], []).append(event_doc)
+
+        events_by_session = {}
+        for session_id, event_docs in docs_by_session.items():
+            if num_recent_events and len(event_docs) >= num_recent_events:
+                event_docs = _trim_to_turn_start(event_docs)
+            events_by_session[session_id] = [
+                self._doc_to_event(event_doc) for event_doc in event_docs
+            ]
+        return events_by_session
+
     async def delete_session(
         self, *, app_name: str, user_id: str, session_id: str
     ) -> None:
-        self.events_collection.delete_many({"session_id": session_id})
-        self.sessions_collection.delete_one(
+        self.session_cache.invalidate((app_name, user_id, session_id))
+        await asyncio.gather(
+            self.events_collection.delete_many({"session_id": session_id}),
+            self.leases.delete_released([session_id]),
+        )
+        await self.sessions_collection.delete_one(
             {"_id": session_id, "app_name": app_name, "user_id": user_id}
         )
 
-    async def append_event(self, session: Session, event: Event) -> Event:
-        if event.partial:
-            return event
+    async def delete_sessions(
+        self,
+        *,
+        app_name: str,
+        user_id: Optional[str] = None,
+        session_ids: Optional[list[str]] = None,
+        batch_size: int = 1000,
+        on_progress: Optional[Callable[[int], Any]] = None,
+        on_deleted: Optional[Callable[[list[str]], Any]] = None,
+    ) -> int:
+        """Deletes many sessions with their events and leases.
+
+        Deletes every session of ``app_name``, narrowed to ``user_id`` and/or
+        ``session_ids`` when given. Sessions are removed in batches of
+        ``batch_size`` in ``_id`` order. Each session's lease is taken first,
+        so no turn can start on it mid-delete; sessions whose lease is held
+        by a running turn are skipped and left in place. Events go before the
+        session documents, so an interrupted run can simply be repeated.
+        ``on_deleted`` receives the ids of each deleted batch while their
+        leases are still held, and ``on_progress`` the running count after
+        every batch; both are awaited when they return an awaitable. Returns
+        the number of sessions deleted.
+        """
+        query: dict[str, Any] = {"app_name": app_name}
+        if user_id is not None:
+            query["user_id"] = user_id
+        id_filter: dict[str, Any] = {}
+        if session_ids is not None:
+            id_filter["$in"] = list(session_ids)
+
+        deleted = 0
+        skipped = 0
+        while True:
+            if id_filter:
+                query["_id"] = id_filter
+            docs = await self.sessions_collection.find(
+                query, {"user_id": 1}
+            ).sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                if skipped:
+                    logger.warning(
+                        "Skipped %d sessions of %s that were in use", skipped, app_name
+                    )
+                return deleted
+            id_filter["$gt"] = docs[-1]["_id"]
 
-        session_doc = self.sessions_collection.find_one(
-            {"_id": session.id, "app_name": session.app_name, "user_id": session.user_id}
+            leases = await asyncio.gather(
+                *(self.leases.try_acquire(doc["_id"]) for doc in docs)
+            )
+            held = [lease for lease in leases if lease is not None]
+            skipped += len(docs) - len(held)
+            if not held:
+                continue
+            user_ids = {doc["_id"]: doc.get("user_id") for doc in docs}
+            ids = [lease.session_id for lease in held]
+            try:
+                await self.events_collection.delete_many({"session_id": {"$in": ids}})
+                result = await self.sessions_collection.delete_many({"_id": {"$in": ids}})
+                for session_id in ids:
+                    self.session_cache.invalidate((app_name, user_ids[session_id], session_id))
+                if on_deleted:
+                    callback_result = on_deleted(ids)
+                    if inspect.isawaitable(callback_result):
+                        await callback_result
+            finally:
+                await self.leases.delete_held(held)
+            deleted += result.deleted_count
+            if on_progress:
+                progress_result = on_progress(deleted)
+                if inspect.isawaitable(progress_result):
+                    await progress_result
+
+    async def start_delete_sessions_job(
+        self,
+        *,
+        app_name: str,
+        user_id: Optional[str] = None,
+        session_ids: Optional[list[str]] = None,
+        on_deleted: Optional[Callable[[list[str]], Any]] = None,
+    ) -> DeleteSessionsJob:
+        """Runs delete_sessions as a background task and returns its job record.
+
+        Progress is stored in MongoDB, so any worker can report it through
+        get_delete_sessions_job. ``on_deleted`` is passed on to delete_sessions.
+        """
+        job = DeleteSessionsJob(id=str(uuid.uuid4()), app_name=app_name)
+        await self.delete_jobs_collection.insert_one(
+            {
+                "_id": job.id,
+                "app_name": app_name,
+                "status": job.status,
+                "total": 0,
+                "deleted": 0,
+                "error": None,
+                "updated_at": _now(),
+            }
         )
-        if not session_doc:
-            raise ValueError(f"Session with id {session.id} not found.")
 
-        update_time = session_doc.get("update_time")
-        if update_time and update_time.timestamp() > session.last_update_time:
-            raise ValueError(
-                "The last_update_time provided in the session object"
-                f" {datetime.fromtimestamp(session.last_update_time):'%Y-%m-%d %H:%M:%S'} is"
-                " earlier than the update_time in the storage_session"
-                f" {datetime.fromtimestamp(update_time.timestamp()):'%Y-%m-%d %H:%M:%S'}."
-                " Please check if it is a stale session."
+        async def save_progress(**fields: Any) -> None:
+            await self.delete_jobs_collection.update_one(
+                {"_id": job.id}, {"$set": {**fields, "updated_at": _now()}}
             )
 
-        app_state_doc = self.app_states_collection.find_one({"_id": session.app_name})
-        user_state_doc = self.user_states_collection.find_one(
-            {"_id": f"{session.app_name}_{session.user_id}"}
+        async def run():
+            query: dict[str, Any] = {"app_name": app_name}
+            if user_id is not None:
+                query["user_id"] = user_id
+            if session_ids is not None:
+                query["_id"] = {"$in": list(session_ids)}
+            try:
+                await save_progress(
+                    total=await self.sessions_collection.count_documents(query)
+                )
+                await self.delete_sessions(
+                    app_name=app_name,
+                    user_id=user_id,
+                    session_ids=session_ids,
+                    on_progress=lambda count: save_progress(deleted=count),
+                    on_deleted=on_deleted,
+                )
+                await save_progress(status="done")
+            except Exception as e:
+                logger.exception("Bulk delete job %s failed", job.id)
+                await save_progress(status="failed", error=str(e))
+
+        task = asyncio.create_task(run())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return job
+
+    async def get_delete_sessions_job(self, job_id: str) -> Optional[DeleteSessionsJob]:
+        doc = await self.delete_jobs_collection.find_one({"_id": job_id})
+        if not doc:
+            return None
+        return DeleteSessionsJob(
+            id=doc["_id"],
+            app_name=doc["app_name"],
+            status=doc.get("status", "running"),
+            total=doc.get("total", 0),
+            deleted=doc.get("deleted", 0),
+            error=doc.get("error"),
         )
 
-        app_state = app_state_doc.get("state", {}) if app_state_doc else {}
-        user_state = user_state_doc.get("state", {}) if user_state_doc else {}
-        session_state = session_doc.get("state", {})
+    async def acquire_session_lease(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        ttl: Optional[float] = None,
+        wait_timeout: Optional[float] = None,
+    ) -> SessionLease:
+        """Waits for exclusive use of a session across workers.
+
+        Raises ``SessionLeaseTimeout`` if the lease is still held by someone
+        else after ``wait_timeout`` seconds. The cached copy of the session
+        is dropped when the previous holder was another worker, so the turn
+        starts from what that worker wrote.
+        """
+        lease = await self.leases.acquire(session_id, ttl=ttl, wait_timeout=wait_timeout)
+        if lease.previous_owner != self.leases.owner_id:
+            self.session_cache.invalidate((app_name, user_id, session_id))
+        return lease
+
+    async def release_session_lease(self, lease: SessionLease) -> None:
+        await self.leases.release(lease)
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        if event.partial:
+            return event
 
         app_state_delta = {}
         user_state_delta = {}
@@ -275,51 +762,184 @@ class MongodbSessionService(BaseSessionService):
                 _extract_state_delta(event.actions.state_delta)
             )
 
+        now = _now()
+
+        # The staleness check, the session state delta and the update_time
+        # touch are folded into a single conditional update.
+        session_filter, session_update = self._conditional_session_update(session, now)
+        result = await self.sessions_collection.update_one(
+            session_filter,
+            _state_update(session_state_delta, set_fields=session_update),
+        )
+        if result.matched_count == 0:
+            await self._raise_append_conflict(session)
+
+        event_doc = self._event_to_doc(session, event, now)
+        writes = [self.events_collection.insert_one(event_doc)]
         if app_state_delta:
-            app_state.update(app_state_delta)
-            self.app_states_collection.update_one(
-                {"_id": session.app_name}, {"$set": {"state": app_state}}, upsert=True
+            writes.append(
+                self.app_states_collection.update_one(
+                    {"_id": session.app_name},
+                    _state_update(app_state_delta),
+                    upsert=True,
+                )
             )
         if user_state_delta:
-            user_state.update(user_state_delta)
-            self.user_states_collection.update_one(
-                {"_id": f"{session.app_name}_{session.user_id}"},
-                {"$set": {"state": user_state}},
-                upsert=True,
-            )
-        if session_state_delta:
-            session_state.update(session_state_delta)
-            self.sessions_collection.update_one(
-                {"_id": session.id}, {"$set": {"state": session_state}}
+            writes.append(
+                self.user_states_collection.update_one(
+                    {"_id": f"{session.app_name}_{session.user_id}"},
+                    _state_update(user_state_delta),
+                    upsert=True,
+                )
             )
+        await asyncio.gather(*writes)
+        previous_update_time = session.last_update_time
+        session.last_update_time = now.timestamp()
+        self._update_cache_after_append(
+            session,
+            event,
+            previous_update_time,
+            app_state_delta,
+            user_state_delta,
+            session_state_delta,
+        )
 
-        now = datetime.now(TAIPEI_TZ)
-        event_doc = {
-            "_id": event.id,
+        await super().append_event(session=session, event=event)
+        return event
+
+    def _conditional_session_update(
+        self, session: Session, now: datetime
+    ) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Builds the filter and ``$set`` fields of a write to a session document.
+
+        The filter matches only if nobody wrote the session after the caller
+        loaded it and no newer lease holder exists; the fields touch
+        ``update_time`` and stamp the caller's lease token.
+        """
+        session_filter: dict[str, Any] = {
+            "_id": session.id,
             "app_name": session.app_name,
             "user_id": session.user_id,
-            "session_id": session.id,
-            "invocation_id": event.invocation_id,
-            "author": event.author,
-            "actions": pickle.dumps(event.actions),
-            "branch": event.branch,
-            "timestamp": now,
-            "long_running_tool_ids": list(event.long_running_tool_ids if event.long_running_tool_ids else []),
-            "partial": event.partial,
-            "turn_complete": event.turn_complete,
-            "error_code": event.error_code,
-            "error_message": event.error_message,
-            "interrupted": event.interrupted,
-            "content": event.content.model_dump(exclude_none=True, mode="json") if event.content else None,
-            "grounding_metadata": event.grounding_metadata.model_dump(exclude_none=True, mode="json") if event.grounding_metadata else None,
-            "custom_metadata": event.custom_metadata,
         }
-        self.events_collection.insert_one(event_doc)
-
-        self.sessions_collection.update_one(
-            {"_id": session.id}, {"$set": {"update_time": now}}
+        if session.last_update_time:
+            session_filter["update_time"] = {
+                "$lte": datetime.fromtimestamp(session.last_update_time, TAIPEI_TZ)
+            }
+        session_update: dict[str, Any] = {"update_time": now}
+        lease_token = current_lease_token(session.id)
+        if lease_token is not None:
+            session_filter["$or"] = [
+                {"lease_token": {"$exists": False}},
+                {"lease_token": {"$lte": lease_token}},
+            ]
+            session_update["lease_token"] = lease_token
+        return session_filter, session_update
+
+    async def unset_session_state(self, session: Session, keys: list[str]) -> None:
+        """Removes keys from the session's own state layer.
+
+        ADK state deltas can only set values, so keys a newer version of the
+        app no longer uses would otherwise stay in the stored state for good.
+        The write goes through the same staleness and lease checks as
+        append_event. Keys must not contain '.' or start with '$'.
+        """
+        keys = [key for key in keys if key in session.state]
+        if not keys:
+            return
+        now = _now()
+        session_filter, session_update = self._conditional_session_update(session, now)
+        result = await self.sessions_collection.update_one(
+            session_filter,
+            {
+                "$set": session_update,
+                "$unset": {f"state.{key}": "" for key in keys},
+            },
         )
+        if result.matched_count == 0:
+            await self._raise_append_conflict(session)
+
+        previous_update_time = session.last_update_time
         session.last_update_time = now.timestamp()
+        for key in keys:
+            session.state.pop(key, None)
+
+        cache_key = (session.app_name, session.user_id, session.id)
+        entry = self.session_cache.get(cache_key)
+        if entry is None:
+            return
+        if entry.update_time != previous_update_time:
+            self.session_cache.invalidate(cache_key)
+            return
+        for key in keys:
+            entry.session_state.pop(key, None)
+        entry.update_time = session.last_update_time
+        self.session_cache.mark_validated(entry)
+
+    async def _raise_append_conflict(self, session: Session) -> None:
+        """Explains why the conditional update in append_event matched nothing."""
+        self.session_cache.invalidate((session.app_name, session.user_id, session.id))
+        session_doc = await self.sessions_collection.find_one(
+            {"_id": session.id, "app_name": session.app_name, "user_id": session.user_id},
+            {"update_time": 1, "lease_token": 1},
+        )
+        if not session_doc:
+            raise ValueError(f"Session with id {session.id} not found.")
 
-        await super().append_event(session=session, event=event)
-        return event
+        lease_token = current_lease_token(session.id)
+        if lease_token is not None and session_doc.get("lease_token", 0) > lease_token:
+            raise ValueError(
+                f"The lease on session {session.id} (token {lease_token}) has been"
+                f" taken over by a newer holder (token {session_doc['lease_token']})."
+            )
+
+        update_time = _to_timestamp(session_doc.get("update_time"))
+        raise ValueError(
+            "The last_update_time provided in the session object"
+            f" {datetime.fromtimestamp(session.last_update_time):'%Y-%m-%d %H:%M:%S'} is"
+            " earlier than the update_time in the storage_session"
+            f" {datetime.fromtimestamp(update_time):'%Y-%m-%d %H:%M:%S'}."
+            " Please check if it is a stale session."
+        )
+
+    async def migrate_pickled_events(self, batch_size: int = 500) -> int:
+        """Rewrites events whose actions are still pickled into the current codec.
+
+        Runs in batches of ``batch_size`` documents in ``_id`` order and
+        returns the number of events migrated. Events that fail to decode are
+        logged and left as they are, so one bad document does not stop the
+        run. Safe to run repeatedly or while the service is live.
+        """
+        # Reading pickles is enabled only here; the service's own codec
+        # rejects them.
+        pickle_codec = JsonEventCodec(allow_pickle=True)
+        migrated = 0
+        skipped = 0
+        query: dict[str, Any] = {"actions": {"$type": "binData"}}
+        while True:
+            docs = await self.events_collection.find(
+                query, {"actions": 1}
+            ).sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                if skipped:
+                    logger.warning("Left %d undecodable pickled events in place", skipped)
+                return migrated
+            query["_id"] = {"$gt": docs[-1]["_id"]}
+
+            requests = []
+            for doc in docs:
+                try:
+                    actions = pickle_codec.decode_actions(doc["actions"])
+                except Exception:
+                    skipped += 1
+                    logger.exception("Failed to decode pickled actions of event %s", doc["_id"])
+                    continue
+                requests.append(
+                    UpdateOne(
+                        {"_id": doc["_id"], "actions": doc["actions"]},
+                        {"$set": {"actions": self.event_codec.encode_actions(actions)}},
+                    )
+                )
+            if not requests:
+                continue
+            result = await self.events_collection.bulk_write(requests, ordered=False)
+            migrated += result.modified_count
@@ -0,0 +1,113 @@
+import copy
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from google.adk.events.event import Event
+
+CacheKey = tuple[str, str, str]
+
+
+def copy_state(state: dict[str, Any]) -> dict[str, Any]:
+    """Copies the mutable values of a state layer; strings and numbers are shared.
+
+    Cached layers are handed to many sessions, so a caller mutating a nested
+    dict or list in place must not be able to change what the cache holds.
+    """
+    return {
+        key: copy.deepcopy(value) if isinstance(value, (dict, list, set)) else value
+        for key, value in state.items()
+    }
+
+
+@dataclass
+class CachedSession:
+    """The stored layers of one session, as last seen in MongoDB."""
+
+    app_state: dict[str, Any]
+    user_state: dict[str, Any]
+    session_state: dict[str, Any]
+    events: list[Event]
+    update_time: Optional[float]
+    # The number of recent events the entry was loaded with (None: all).
+    event_window: Optional[int] = None
+    validated_at: float = field(default_factory=time.monotonic)
+
+
+class SessionCache:
+    """An LRU cache of sessions keyed by ``(app_name, user_id, session_id)``.
+
+    Memory is bounded both by the number of sessions and by the total number
+    of cached events. Entries are revalidated against the stored
+    ``update_time`` before every use. Callers that know no other writer can
+    touch their sessions may opt in to ``revalidate_after``: an entry
+    validated less than that many seconds ago is then served as is.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        max_events: int = 50000,
+        revalidate_after: Optional[float] = None,
+    ):
+        self.max_sessions = max_sessions
+        self.max_events = max_events
+        self.revalidate_after = revalidate_after
+        self._entries: OrderedDict[CacheKey, CachedSession] = OrderedDict()
+        self._event_count = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: CacheKey) -> Optional[CachedSession]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def is_fresh(self, entry: CachedSession) -> bool:
+        if self.revalidate_after is None:
+            return False
+        return time.monotonic() - entry.validated_at < self.revalidate_after
+
+    def mark_validated(self, entry: CachedSession) -> None:
+        entry.validated_at = time.monotonic()
+
+    def put(self, key: CacheKey, entry: CachedSession) -> None:
+        self.invalidate(key)
+        self._entries[key] = entry
+        self._event_count += len(entry.events)
+        self._evict()
+
+    def replace_events(self, key: CacheKey, events: list[Event]) -> None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        self._event_count += len(events) - len(entry.events)
+        entry.events = events
+        self._evict()
+
+    def invalidate(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._event_count -= len(entry.events)
+
+    def invalidate_where(
+        self, app_name: str, user_id: Optional[str] = None
+    ) -> None:
+        """Drops every entry of ``app_name`` (and ``user_id`` when given)."""
+        for key in [
+            k
+            for k in self._entries
+            if k[0] == app_name and (user_id is None or k[1] == user_id)
+        ]:
+            self.invalidate(key)
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_sessions
+            or self._event_count > self.max_events
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._event_count -= len(entry.events)
@@ -0,0 +1,216 @@
+import asyncio
+import contextvars
+import logging
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+TAIPEI_TZ = ZoneInfo("Asia/Taipei")
+
+logger = logging.getLogger(__name__)
+
+# session_id -> fencing token of the lease held by the current task. Tasks
+# spawned while a lease is held (e.g. ParallelAgent branches) inherit it.
+_lease_tokens: contextvars.ContextVar[dict[str, int]] = contextvars.ContextVar(
+    "session_lease_tokens", default={}
+)
+
+
+def current_lease_token(session_id: str) -> Optional[int]:
+    """The fencing token the current task holds for ``session_id``, if any."""
+    return _lease_tokens.get().get(session_id)
+
+
+class SessionLeaseTimeout(TimeoutError):
+    """Raised when a session lease could not be acquired within the wait timeout."""
+
+
+@dataclass
+class SessionLease:
+    """A held lease on one session.
+
+    ``token`` increases with every acquisition of the same session, so a
+    write carrying an older token can be told apart from the current
+    holder's. ``previous_owner`` is the owner id of the last holder.
+    """
+
+    session_id: str
+    holder: str
+    token: int
+    ttl: float
+    previous_owner: Optional[str] = None
+    lost: bool = False
+    _heartbeat: Optional[asyncio.Task] = field(default=None, repr=False)
+    _restore_tokens: Optional[dict[str, int]] = field(default=None, repr=False)
+
+
+class SessionLeaseManager:
+    """Per-session leases stored in MongoDB, shared by every worker.
+
+    A lease document is keyed by session id and holds the current holder,
+    its expiry and a monotonically increasing fencing token. A lease is
+    taken by a conditional upsert that only matches an expired document; a
+    held lease makes the upsert collide on ``_id``, and the caller polls
+    with backoff until the holder releases it, it expires, or
+    ``wait_timeout`` passes. While held, the lease is renewed every third
+    of its ``ttl`` so long turns keep it. Lease documents are not deleted
+    on release, which keeps the token monotonic.
+    """
+
+    def __init__(
+        self,
+        collection,
+        ttl: float = 30.0,
+        wait_timeout: float = 60.0,
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 0.5,
+    ):
+        self.collection = collection
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        # Identifies this process, so a new holder can tell whether the last
+        # writer was another worker.
+        self.owner_id = str(uuid.uuid4())
+        self._release_tasks: set[asyncio.Task] = set()
+
+    async def acquire(
+        self,
+        session_id: str,
+        ttl: Optional[float] = None,
+        wait_timeout: Optional[float] = None,
+    ) -> SessionLease:
+        ttl = ttl or self.ttl
+        wait_timeout = self.wait_timeout if wait_timeout is None else wait_timeout
+        holder = str(uuid.uuid4())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait_timeout
+        interval = self.poll_interval
+        while True:
+            previous = await self._try_acquire(session_id, holder, ttl)
+            if previous is not False:
+                lease = SessionLease(
+                    session_id=session_id,
+                    holder=holder,
+                    token=(previous or {}).get("token", 0) + 1,
+                    ttl=ttl,
+                    previous_owner=(previous or {}).get("owner"),
+                )
+                lease._heartbeat = asyncio.create_task(self._renew_periodically(lease))
+                tokens = _lease_tokens.get()
+                lease._restore_tokens = tokens
+                _lease_tokens.set({**tokens, session_id: lease.token})
+                return lease
+            if loop.time() + interval > deadline:
+                raise SessionLeaseTimeout(
+                    f"Timed out waiting for the lease on session {session_id}."
+                )
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    async def try_acquire(
+        self, session_id: str, ttl: Optional[float] = None
+    ) -> Optional[SessionLease]:
+        """Takes the lease only if nobody holds it; returns None otherwise.
+
+        Meant for short maintenance work such as deleting the session: the
+        lease is not renewed and not made current for the calling task.
+        """
+        holder = str(uuid.uuid4())
+        ttl = ttl or self.ttl
+        previous = await self._try_acquire(session_id, holder, ttl)
+        if previous is False:
+            return None
+        return SessionLease(
+            session_id=session_id,
+            holder=holder,
+            token=(previous or {}).get("token", 0) + 1,
+            ttl=ttl,
+            previous_owner=(previous or {}).get("owner"),
+        )
+
+    async def _try_acquire(self, session_id: str, holder: str, ttl: float):
+        """Returns the previous lease document (None if new), or False if held."""
+        now = datetime.now(TAIPEI_TZ)
+        try:
+            return await self.collection.find_one_and_update(
+                {"_id": session_id, "expires_at": {"$lte": now}},
+                {
+                    "$set": {
+                        "holder": holder,
+                        "owner": self.owner_id,
+                        "expires_at": now + timedelta(seconds=ttl),
+                    },
+                    "$inc": {"token": 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+        except DuplicateKeyError:
+            return False
+
+    async def _renew_periodically(self, lease: SessionLease) -> None:
+        while True:
+            await asyncio.sleep(lease.ttl / 3)
+            try:
+                result = await self.collection.update_one(
+                    {"_id": lease.session_id, "holder": lease.holder},
+                    {
+                        "$set": {
+                            "expires_at": datetime.now(TAIPEI_TZ)
+                            + timedelta(seconds=lease.ttl)
+                        }
+                    },
+                )
+            except Exception:
+                logger.exception("Failed to renew the lease on session %s", lease.session_id)
+                continue
+            if result.matched_count == 0:
+                # Another holder took over; its fencing token now rejects
+                # this holder's writes.
+                lease.lost = True
+                logger.warning("Lost the lease on session %s", lease.session_id)
+                return
+
+    async def release(self, lease: SessionLease) -> None:
+        if lease._heartbeat is not None:
+            lease._heartbeat.cancel()
+            lease._heartbeat = None
+        if lease._restore_tokens is not None:
+            _lease_tokens.set(lease._restore_tokens)
+            lease._restore_tokens = None
+        if lease.lost:
+            return
+        # Shielded, so a caller cancelled mid-release (e.g. a streaming
+        # response whose client disconnected) still frees the lease instead
+        # of leaving it held until it expires.
+        task = asyncio.create_task(
+            self.collection.update_one(
+                {"_id": lease.session_id, "holder": lease.holder},
+                {"$set": {"expires_at": datetime.now(TAIPEI_TZ)}},
+            )
+        )
+        self._release_tasks.add(task)
+        task.add_done_callback(self._release_tasks.discard)
+        await asyncio.shield(task)
+
+    async def delete_held(self, leases: list[SessionLease]) -> None:
+        """Removes the lease documents of deleted sessions whose leases the caller holds."""
+        await self.collection.delete_many(
+            {
+                "_id": {"$in": [lease.session_id for lease in leases]},
+                "holder": {"$in": [lease.holder for lease in leases]},
+            }
+        )
+
+    async def delete_released(self, session_ids: list[str]) -> None:
+        """Removes the lease documents of deleted sessions that nobody holds."""
+        await self.collection.delete_many(
+            {"_id": {"$in": session_ids}, "expires_at": {"$lte": datetime.now(TAIPEI_TZ)}}
+        )
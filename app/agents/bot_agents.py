@@ -1,17 +1,35 @@
-from google.adk.agents import LlmAgent
+from google.adk.agents import BaseAgent, LlmAgent, ParallelAgent, SequentialAgent
+from google.adk.agents.readonly_context import ReadonlyContext
+from google.adk.agents.callback_context import CallbackContext
+from google.genai import types
 from google.adk.tools import agent_tool, ToolContext
 from app.core.config import settings
+from app.models.schemas import ChatStructuredOutput
+from app.prompts.templates import HANDOFF_VERDICT_ONLY_NOTE
 
 import asyncio
-from bson import ObjectId
+import json
+from typing import Optional
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 
-from app.core.database import user_collection, agent_collection, session_collection
+from app.core.database import user_collection, session_collection
+from app.services import agent_cache, faq_index, handoff_matcher
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 TAIPEI_TZ = ZoneInfo("Asia/Taipei")
+
+# 對話引擎：多代理 (main_router 呼叫 faq_expert / handoff_expert)、單次呼叫的結構化輸出，
+# 或平行 (faq_expert 與 handoff_expert 同時執行後由 main_router 彙整)
+CHAT_ENGINE_MULTI_AGENT = "multi_agent"
+CHAT_ENGINE_SINGLE_PASS = "single_pass"
+CHAT_ENGINE_PARALLEL = "parallel"
+CHAT_ENGINES = (CHAT_ENGINE_MULTI_AGENT, CHAT_ENGINE_SINGLE_PASS, CHAT_ENGINE_PARALLEL)
+# 以 sub-agent 身分執行 (平行模式) 時會直接產生 event 的專家代理
+EXPERT_AGENT_NAMES = ("faq_expert", "handoff_expert")
+# 轉接成功時的回覆 (與各指令中要求模型使用的句子相同)
+HANDOFF_REPLY_TEXT = "已轉交真人客服處理，會盡快回覆您！"
 import time
 import random
 import string
@@ -31,10 +49,15 @@ async def call_human_support(tool_context: ToolContext, query: str) -> dict:
         {"text": "已轉接真人客服"}
     """
     # 從 state 拿真正的 user id, agent id 與 session id
-    user_id = tool_context.state.get("current_user_id")
-    agent_id = tool_context.state.get("current_agent_id")
-    session_id = tool_context.state.get("current_session_id")
+    return await notify_human_support(
+        tool_context.state.get("current_user_id"),
+        tool_context.state.get("current_agent_id"),
+        tool_context.state.get("current_session_id"),
+        query
+    )
 
+async def notify_human_support(user_id: str, agent_id: str, session_id: str, query: str) -> dict:
+    """將 session 改為真人模式並通知商家 (call_human_support 與單次呼叫模式共用)"""
     if not user_id or not agent_id or not session_id:
         print(f"Error: Missing context in tool state. user_id: {user_id}, agent_id: {agent_id}, session_id: {session_id}")
         return {"text": "轉接失敗，系統上下文缺失。"}
@@ -47,7 +70,7 @@ async def call_human_support(tool_context: ToolContext, query: str) -> dict:
         )
         
         # 2. 獲取 Agent 與部署資訊 (為了拿 admin_id 和 access_token)
-        agent = await agent_collection.find_one({"_id": ObjectId(agent_id)})
+        agent = await agent_cache.get_agent(agent_id)
         if not agent:
             return {"text": "轉接失敗，找不到客服配置。"}
         
@@ -76,31 +99,140 @@ async def call_human_support(tool_context: ToolContext, query: str) -> dict:
         traceback.print_exc()
         return {"text": f"轉接過程發生錯誤: {str(e)}"}
 
-# Note: instructions are injected dynamically via session state
-faq_agent = LlmAgent(
-    name="faq_expert", 
-    model=settings.AGENT_MODEL, 
-    instruction="{faq_instruction}",
-    description="FAQ 智能助手",
-    output_key="faq_result"
-)
-
-handoff_agent = LlmAgent(
-    name="handoff_expert", 
-    model=settings.AGENT_MODEL, 
-    instruction="{handoff_instruction}",
-    description="轉接真人客服智能助手",
-    tools=[call_human_support],
-    output_key="handoff_result"
-)
-
-faq_tool = agent_tool.AgentTool(agent=faq_agent)
-handoff_tool = agent_tool.AgentTool(agent=handoff_agent)
-
-main_agent = LlmAgent(
-    name="main_router",
-    model=settings.AGENT_MODEL,
-    instruction="{router_instruction}",
-    description="負責協調所有客服流程、決定要呼叫哪些 tool，並彙整各個 tool 的回傳結果後產出統一的回覆",
-    tools=[faq_tool, handoff_tool, call_human_support]
-)
+def _user_text(ctx: ReadonlyContext) -> str:
+    # faq_expert 以 AgentTool 呼叫時，user_content 為 main_router 傳入的問題
+    content = ctx.user_content
+    if not content or not content.parts:
+        return ""
+    return "".join(p.text for p in content.parts if getattr(p, "text", None))
+
+def retrieved_faq_instruction(agent_id: str, version: int, config: dict):
+    """每輪依問題從 FAQ 索引取出相關 FAQ 組成指令"""
+    def provider(ctx: ReadonlyContext) -> str:
+        return faq_index.render_faq_instruction(agent_id, version, config, _user_text(ctx))
+    return provider
+
+def static_instruction(text: str):
+    """已解析好的指令，以 provider 形式提供讓 ADK 不再對內容做 {變數} 替換"""
+    def provider(ctx: ReadonlyContext) -> str:
+        return text
+    return provider
+
+def _faq_agent(instruction) -> LlmAgent:
+    return LlmAgent(
+        name="faq_expert", 
+        model=settings.AGENT_MODEL, 
+        instruction=instruction,
+        description="FAQ 智能助手",
+        output_key="faq_result"
+    )
+
+def skip_handoff_on_prefilter_miss(callback_context: CallbackContext) -> Optional[types.Content]:
+    """
+    run_chat 以轉接關鍵字判斷本輪訊息與轉接完全無關時 (handoff_matcher.current_verdict 為 miss)，
+    handoff_expert 不呼叫模型，直接回傳不轉接的結果
+    """
+    if handoff_matcher.current_verdict.get() != handoff_matcher.MISS:
+        return None
+    result = {"hand_off": False, "reason": "使用者問題不符合設定的轉接真人客服條件"}
+    callback_context.state["handoff_result"] = result
+    return types.Content(role="model", parts=[types.Part.from_text(text=json.dumps(result, ensure_ascii=False))])
+
+def _handoff_agent(instruction, can_hand_off: bool = True) -> LlmAgent:
+    """can_hand_off 為 False 時只回傳判斷結果，不掛 call_human_support"""
+    return LlmAgent(
+        name="handoff_expert", 
+        model=settings.AGENT_MODEL, 
+        instruction=instruction,
+        description="轉接真人客服智能助手",
+        tools=[call_human_support] if can_hand_off else [],
+        output_key="handoff_result",
+        before_agent_callback=skip_handoff_on_prefilter_miss
+    )
+
+def build_agent_tree(faq_instruction, handoff_instruction, router_instruction) -> LlmAgent:
+    """建立一組 main_router / faq_expert / handoff_expert 代理"""
+    faq_tool = agent_tool.AgentTool(agent=_faq_agent(faq_instruction))
+    handoff_tool = agent_tool.AgentTool(agent=_handoff_agent(handoff_instruction))
+
+    return LlmAgent(
+        name="main_router",
+        model=settings.AGENT_MODEL,
+        instruction=router_instruction,
+        description="負責協調所有客服流程、決定要呼叫哪些 tool，並彙整各個 tool 的回傳結果後產出統一的回覆",
+        tools=[faq_tool, handoff_tool, call_human_support]
+    )
+
+def single_pass_instruction(agent_id: str, version: int, config: dict):
+    """單次呼叫模式的指令，每輪依使用者問題放入相關 FAQ"""
+    instruction = config.get("single_pass_instruction", "")
+    def provider(ctx: ReadonlyContext) -> str:
+        return instruction + faq_index.render_faq_section(agent_id, version, config, _user_text(ctx))
+    return provider
+
+def build_single_pass_agent(agent_id: str, version: int, config: dict) -> LlmAgent:
+    """
+    單次呼叫模式：一次模型呼叫直接產生 ChatStructuredOutput
+    不掛任何 tool (掛 tool 時轉接需要第二次呼叫)，hand_off 為 true 時由 run_chat 呼叫 notify_human_support
+    """
+    return LlmAgent(
+        name="single_pass",
+        model=settings.AGENT_MODEL,
+        instruction=single_pass_instruction(agent_id, version, config),
+        description="以單次模型呼叫完成 FAQ 查詢、轉接判斷與回覆",
+        output_schema=ChatStructuredOutput
+    )
+
+def expert_results_instruction(router_instruction: str, enable_handoff: bool):
+    """平行模式 main_router 的指令：附上本輪 faq_expert 與 handoff_expert 的結果"""
+    def provider(ctx: ReadonlyContext) -> str:
+        handoff_result = ctx.state.get('handoff_result', '') if enable_handoff else '{"hand_off": false, "reason": "不提供轉接真人客服服務"}'
+        return (
+            router_instruction
+            + f"\n\n# faq_expert 結果\n{ctx.state.get('faq_result', '')}"
+            + f"\n\n# handoff_expert 結果\n{handoff_result}"
+        )
+    return provider
+
+def build_parallel_agent(agent_id: str, version: int, config: dict) -> SequentialAgent:
+    """
+    平行模式：faq_expert 與 handoff_expert 直接對使用者訊息同時執行，再由 main_router 彙整回覆
+    一輪的延遲為較慢的 sub-agent 加上 main_router，而不是 main_router 依序呼叫兩個 tool 的總和
+    handoff_expert 與 faq_expert 同時執行，此時還不知道 FAQ 能否解決，因此只回傳判斷結果；
+    FAQ 無法解決且判斷需轉接時，由 run_chat 在執行後呼叫 notify_human_support
+    """
+    experts = [_faq_agent(retrieved_faq_instruction(agent_id, version, config))]
+    # 未啟用轉接時 handoff_expert 的結果固定，不需呼叫
+    enable_handoff = bool(config.get("enable_handoff"))
+    if enable_handoff:
+        experts.append(_handoff_agent(
+            static_instruction(config.get("handoff_instruction", "") + HANDOFF_VERDICT_ONLY_NOTE),
+            can_hand_off=False
+        ))
+    router = LlmAgent(
+        name="main_router",
+        model=settings.AGENT_MODEL,
+        instruction=expert_results_instruction(config.get("parallel_router_instruction", ""), enable_handoff),
+        description="彙整 faq_expert 與 handoff_expert 的結果後產出統一的回覆",
+        tools=[call_human_support]
+    )
+    return SequentialAgent(
+        name="parallel_pipeline",
+        sub_agents=[ParallelAgent(name="experts", sub_agents=experts), router]
+    )
+
+def build_configured_agent(agent_id: str, version: int, config: dict) -> BaseAgent:
+    """以某個版本的 Agent 設定建立指令已解析完成的代理 (FAQ 指令依問題檢索)"""
+    if config.get("chat_engine") == CHAT_ENGINE_SINGLE_PASS:
+        return build_single_pass_agent(agent_id, version, config)
+    if config.get("chat_engine") == CHAT_ENGINE_PARALLEL and "parallel_router_instruction" in config:
+        return build_parallel_agent(agent_id, version, config)
+    if config.get("faq_retrieval"):
+        faq_instruction = retrieved_faq_instruction(agent_id, version, config)
+    else:
+        faq_instruction = static_instruction(config.get("faq_instruction", ""))
+    return build_agent_tree(
+        faq_instruction,
+        static_instruction(config.get("handoff_instruction", "")),
+        static_instruction(config.get("router_instruction", ""))
+    )
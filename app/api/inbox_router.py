@@ -17,6 +17,7 @@ from app.core.database import (
     user_collection,
     member_collection,
 )
+from app.services import agent_cache
 
 TAIPEI_TZ = ZoneInfo("Asia/Taipei")
 
@@ -212,8 +213,9 @@ async def set_notify_user(agent_id: str, body: SetNotifyUserBody, userId: str =
     await verify_admin_agent_access(userId, body.agent_id)
     await agent_collection.update_one(
         {"_id": ObjectId(body.agent_id)},
-        {"$set": {"admin_notify_id": body.line_user_id or None}}
+        {"$set": {"admin_notify_id": body.line_user_id or None, "updated_at": datetime.now(TAIPEI_TZ)}}
     )
+    agent_cache.invalidate_agent(body.agent_id)
     return {"status": "ok"}
 
 
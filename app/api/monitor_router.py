@@ -9,11 +9,11 @@ from app.core.database import (
     agent_collection,
     session_collection,
     chat_collection,
-    subagent_collection,
     daily_usage_collection,
     user_collection,
     async_db,
 )
+from app.services import subagent_registry
 
 monitor_router = APIRouter()
 
@@ -61,10 +61,7 @@ async def get_records(
 ):
     skip = (page - 1) * limit
 
-    # Cache subagent names
-    subagent_cache = {}
-    async for sa in subagent_collection.find({}, {"title": 1}):
-        subagent_cache[str(sa["_id"])] = sa.get("title")
+    await subagent_registry.ensure_loaded()
 
     # Filter for used_token
     query = {}
@@ -139,7 +136,7 @@ async def get_records(
                     subagents.append(title)
             else:
                 s_id = str(u)
-                resolved = subagent_cache.get(s_id, s_id)
+                resolved = subagent_registry.get_title(s_id) or s_id
                 if resolved not in subagents:
                     subagents.append(resolved)
 
@@ -177,6 +174,12 @@ async def get_records(
     return {"records": result}
 
 
+@monitor_router.post("/subagents/refresh")
+async def refresh_subagents(_: str = Depends(verify_monitor_access)):
+    await subagent_registry.refresh()
+    return {"status": "ok"}
+
+
 @monitor_router.get("/stats")
 async def get_stats(days: int = Query(7), usage_type: Optional[str] = Query(None), _: str = Depends(verify_monitor_access)):
     end_date = datetime.now()
@@ -91,6 +91,11 @@ async def chat(data: ChatRequest):
     print(f"Chat Request: {data}")
     return await chat_controller.chat(data)
 
+@api_router.post("/chat/stream")
+async def chat_stream(data: ChatRequest):
+    print(f"Chat Stream Request: {data}")
+    return await chat_controller.chat_stream(data)
+
 @api_router.post("/deploy_line")
 async def deploy_line(data: DeployLineRequest):
     print(f"Deploy Line Request: {data}")
@@ -150,6 +155,23 @@ async def toggle_subagent(agent_id: str, data: Dict[str, Any]):
     success = await agent_service.toggle_subagent_enable(agent_id, admin_id, subagent_id, enable)
     return {"status": "ok" if success else "error"}
 
+@api_router.post("/admin/agent/{agent_id}/clear_sessions")
+async def clear_sessions(agent_id: str, data: Dict[str, Any]):
+    admin_id = data.get("userId")
+    if not admin_id:
+        return {"error": "userId is required"}
+    job = await agent_service.start_clear_agent_sessions(agent_id, admin_id)
+    if not job:
+        return {"error": "Not found or unauthorized"}
+    return {"status": "ok", "job": job}
+
+@api_router.get("/admin/agent/{agent_id}/clear_sessions/{job_id}")
+async def get_clear_sessions_job(agent_id: str, job_id: str, userId: str):
+    job = await agent_service.get_clear_sessions_job(agent_id, userId, job_id)
+    if not job:
+        return {"error": "Job not found"}
+    return {"status": "ok", "job": job}
+
 @api_router.post("/line-webhook/{channel_id}")
 async def line_webhook(channel_id: str, request: Request, x_line_signature: str = Header(None)):
     return await line_controller.line_webhook(channel_id, request, x_line_signature)
@@ -1,4 +1,6 @@
 import uuid
+import json
+from fastapi.responses import StreamingResponse
 from app.models.schemas import ChatRequest
 from app.services import agent_service
 
@@ -15,3 +17,27 @@ async def chat(data: ChatRequest):
         source=data.source
     )
     return result
+
+def _sse(frame: dict) -> str:
+    return f"event: {frame['type']}\ndata: {json.dumps(frame, ensure_ascii=False, default=str)}\n\n"
+
+async def chat_stream(data: ChatRequest):
+    frames = agent_service.stream_chat(
+        user_message=data.message,
+        line_user_id=data.line_user_id,
+        user_name=data.user_name,
+        agent_id=data.agent_id,
+        session_id=data.session_id,
+        source=data.source
+    )
+
+    async def event_source():
+        async for frame in frames:
+            yield _sse(frame)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        # 避免反向代理緩衝，讓片段即時送達
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
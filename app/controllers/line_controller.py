@@ -18,7 +18,7 @@ from linebot.models import MessageEvent, TextMessage, TextSendMessage, PostbackE
 
 from app.services import line_richmenu_service
 from app.models.schemas import DeployLineRequest
-from app.services import agent_service
+from app.services import agent_service, agent_cache, chat_queue
 from app.core.config import settings
 from app.core.database import agent_collection, user_collection, session_collection, chat_collection, member_collection
 
@@ -88,6 +88,7 @@ async def deploy_line(data: DeployLineRequest):
                 }
             }
         )
+        agent_cache.invalidate_agent(data.agent_id)
         
         line_bot_api.set_webhook_endpoint(webhook_url)
 
@@ -117,8 +118,8 @@ async def line_webhook(channel_id: str, request: Request, x_line_signature: str
     
     agent_id_str = channel_id.replace("agent_", "")
     
-    # 1. 從 MongoDB 抓取部署資訊
-    agent = await agent_collection.find_one({"_id": ObjectId(agent_id_str)})
+    # 1. 從 MongoDB 抓取部署資訊 (有快取)
+    agent = await agent_cache.get_agent(agent_id_str)
     if not agent or agent.get("deploy_type") != "line":
         raise HTTPException(status_code=404, detail="Bot configuration not found")
         
@@ -136,7 +137,8 @@ async def line_webhook(channel_id: str, request: Request, x_line_signature: str
     # 手動解析事件並使用非同步處理，避免跨 Loop 報錯
     try:
         events = handler.parser.parse(payload, x_line_signature)
-        for event in events:
+
+        async def handle_event(event):
             line_user_id = event.source.user_id
             stable_session_id = f"line_{agent_id_str}_{line_user_id}"
 
@@ -217,19 +219,32 @@ async def line_webhook(channel_id: str, request: Request, x_line_signature: str
                     # 2. 顯示 Loading 效果
                     await show_loading(line_user_id, access_token)
                     
-                    # 3. 呼叫 AI Agent
-                    res = await agent_service.run_chat(
-                        user_message=user_msg, 
-                        line_user_id=line_user_id,
-                        user_name=user_name,
-                        agent_id=agent_id_str,
-                        session_id=stable_session_id
-                    )
+                    # 3. 呼叫 AI Agent (同一個 session 依序處理，連續送出的訊息合併成一輪)
+                    async def run_turn(message: str):
+                        return await agent_service.run_chat(
+                            user_message=message, 
+                            line_user_id=line_user_id,
+                            user_name=user_name,
+                            agent_id=agent_id_str,
+                            session_id=stable_session_id
+                        )
+                    res = await chat_queue.submit(stable_session_id, user_msg, run_turn)
+                    # 已併入之後的訊息，由最後一則訊息 (最新的 reply token) 回覆
+                    if res is None:
+                        return
                     
                     reply_text = res.get("response_text")
                     if reply_text:
                         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
 
+        # 同一次 webhook 可能帶有多則訊息，同時處理才能讓 chat_queue 合併
+        results = await asyncio.gather(*(handle_event(event) for event in events), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                import traceback
+                traceback.print_exception(result)
+                print(f"Webhook Error: {str(result)}")
+
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
     except Exception as e:
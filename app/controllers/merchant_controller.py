@@ -1,6 +1,7 @@
 from typing import Dict, Any
+from app.core.config import settings
 from app.models.schemas import FormData
-from app.services import prompt_service, agent_service
+from app.services import prompt_service, agent_service, handoff_matcher
 
 async def generate_prompt(data: FormData):
     # 手動驗證長度 (雙重保障)
@@ -38,8 +39,8 @@ async def confirm_setup(data: Dict[str, Any]):
             # 加入後端驗證
             if not edited_faqs:
                 return {"status": "error", "message": "請至少提供一組 FAQ"}
-            if len(edited_faqs) > 20:
-                return {"status": "error", "message": "FAQ 組數上限為 20 組"}
+            if len(edited_faqs) > settings.FAQ_MAX_COUNT:
+                return {"status": "error", "message": f"FAQ 組數上限為 {settings.FAQ_MAX_COUNT} 組"}
             for faq in edited_faqs:
                 q = faq.get("question", "").strip()
                 a = faq.get("answer", "").strip()
@@ -50,10 +51,7 @@ async def confirm_setup(data: Dict[str, Any]):
             cached_config["faqs"] = edited_faqs
             
         if edited_triggers is not None:
-            if edited_triggers:
-                cached_config["handoff_logic"] = f"當使用者提到以下任何一項時轉接：{', '.join(edited_triggers)}"
-            else:
-                cached_config["handoff_logic"] = ""
+            cached_config["handoff_logic"] = handoff_matcher.format_handoff_logic(edited_triggers)
 
         new_agent_id = await agent_service.initialize_agent_system(cached_config, line_user_id, agent_id)
         return {"status": "ok", "agent_id": new_agent_id}
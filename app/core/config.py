@@ -17,6 +17,46 @@ class Settings(BaseSettings):
     MONGO_DB_NAME: str = os.getenv("MONGO_DB_NAME")
     MONGO_COLLECTION_PREFIX: str = os.getenv("MONGO_COLLECTION_PREFIX")
 
+    # 每次對話載入的最近事件數 (可由 agent 文件的 session_event_window 覆寫)
+    SESSION_EVENT_WINDOW: int = int(os.getenv("SESSION_EVENT_WINDOW", 50))
+    # 多個 worker 之間同一個 session 一次只執行一輪對話：租約有效秒數 (執行中會自動續約)，以及等待前一輪結束的秒數上限
+    SESSION_LEASE_TTL_SECONDS: float = float(os.getenv("SESSION_LEASE_TTL_SECONDS", 30))
+    SESSION_LEASE_WAIT_SECONDS: float = float(os.getenv("SESSION_LEASE_WAIT_SECONDS", 30))
+    # 快取的 session 在確認為最新後幾秒內直接使用，不再查詢資料庫 (每輪對話都持有租約，其他 worker 接手時會清除快取)；0 代表每次都確認
+    SESSION_CACHE_REVALIDATE_SECONDS: float = float(os.getenv("SESSION_CACHE_REVALIDATE_SECONDS", 5))
+
+    # Agent 設定快取 (寫入時會主動失效，命中時比對 updated_at 與其他 worker 同步)
+    AGENT_CACHE_MAX_SIZE: int = int(os.getenv("AGENT_CACHE_MAX_SIZE", 512))
+
+    # 每個 Agent 預先建立好的 Runner 數量上限
+    RUNNER_CACHE_MAX_SIZE: int = int(os.getenv("RUNNER_CACHE_MAX_SIZE", 256))
+
+    # 使用者問題與 FAQ 的相似度 (0~1) 達到此門檻、且兩者去掉語助詞後完全相同時直接回覆 FAQ 答案，不呼叫模型；大於 1 代表停用
+    FAQ_FAST_PATH_THRESHOLD: float = float(os.getenv("FAQ_FAST_PATH_THRESHOLD", 0.9))
+    # 直接回覆時，使用者問題與 FAQ 問題最多可相差的字數 (只能是語助詞等不影響語意的字)
+    FAQ_FAST_PATH_MAX_EXTRA_CHARS: int = int(os.getenv("FAQ_FAST_PATH_MAX_EXTRA_CHARS", 2))
+
+    # 每輪對話放入 faq_expert 指令的 FAQ 筆數，以及每個 Agent 的 FAQ 上限
+    FAQ_RETRIEVAL_TOP_K: int = int(os.getenv("FAQ_RETRIEVAL_TOP_K", 8))
+    FAQ_MAX_COUNT: int = int(os.getenv("FAQ_MAX_COUNT", 2000))
+
+    # Subagent 清單定時刷新間隔 (秒)，0 代表只在啟動與手動刷新時載入
+    SUBAGENT_REFRESH_SECONDS: int = int(os.getenv("SUBAGENT_REFRESH_SECONDS", 600))
+
+    # 對話紀錄背景寫入佇列
+    TRANSCRIPT_QUEUE_SIZE: int = int(os.getenv("TRANSCRIPT_QUEUE_SIZE", 10000))
+    TRANSCRIPT_BATCH_SIZE: int = int(os.getenv("TRANSCRIPT_BATCH_SIZE", 200))
+
+    # LINE 連續訊息合併：最後一則訊息後等待的秒數，以及第一則訊息後最多等待的秒數
+    CHAT_COALESCE_SECONDS: float = float(os.getenv("CHAT_COALESCE_SECONDS", 1.5))
+    CHAT_COALESCE_MAX_SECONDS: float = float(os.getenv("CHAT_COALESCE_MAX_SECONDS", 5))
+    # 合併成一輪的訊息則數與總字數上限，超過的訊息留到下一輪
+    CHAT_COALESCE_MAX_MESSAGES: int = int(os.getenv("CHAT_COALESCE_MAX_MESSAGES", 5))
+    CHAT_COALESCE_MAX_CHARS: int = int(os.getenv("CHAT_COALESCE_MAX_CHARS", 300))
+
+    # 使用量計數器寫回資料庫的間隔 (秒)，也是多個 worker 之間可能超量的時間窗
+    USAGE_SYNC_SECONDS: int = int(os.getenv("USAGE_SYNC_SECONDS", 5))
+
     class Config:
         env_file = ".env"
 
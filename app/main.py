@@ -4,6 +4,8 @@ from app.api.router import api_router
 from app.api.monitor_router import monitor_router
 from app.api.inbox_router import inbox_router
 from app.core.config import settings
+from app.services.agent_service import session_service
+from app.services import subagent_registry, transcript_writer, usage_service
 import uvicorn
 
 app = FastAPI(title="LineBot Dev Backend")
@@ -16,6 +18,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def ensure_session_indexes():
+    # 建立 session 查詢所需的索引
+    await session_service.ensure_indexes()
+
+@app.on_event("startup")
+async def load_subagent_registry():
+    await subagent_registry.start()
+
+@app.on_event("shutdown")
+async def stop_subagent_registry():
+    await subagent_registry.stop()
+
+@app.on_event("startup")
+async def start_transcript_writer():
+    transcript_writer.start()
+
+@app.on_event("shutdown")
+async def drain_transcript_writer():
+    await transcript_writer.stop()
+
+@app.on_event("startup")
+async def start_usage_sync():
+    usage_service.start()
+
+@app.on_event("shutdown")
+async def flush_usage_counters():
+    await usage_service.stop()
+
 # Include the API router with /api prefix
 app.include_router(api_router, prefix="/api")
 app.include_router(monitor_router, prefix="/api/monitor")
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+from bson import ObjectId
+
+from app.core.config import settings
+from app.core.database import agent_collection
+
+# agent_id -> (版本標記, agent 文件)
+_AGENT_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+
+# 判斷快取是否仍是最新版本時讀取的欄位 (修改 Agent 文件時都會更新 updated_at)
+_VERSION_PROJECTION = {"updated_at": 1, "config_version": 1}
+
+def _version_of(doc: Dict[str, Any]) -> tuple:
+    return doc.get("updated_at"), doc.get("config_version")
+
+async def get_agent(agent_id: str) -> Optional[Dict[str, Any]]:
+    """
+    取得 Agent 文件 (有快取)
+    快取命中時只查詢 updated_at 與 config_version 確認仍是最新版本，其他 worker 修改後不會讀到舊的設定
+    回傳的 dict 為共用物件，呼叫端不可修改
+    """
+    cached = _AGENT_CACHE.get(agent_id)
+    if cached:
+        current = await agent_collection.find_one({"_id": ObjectId(agent_id)}, _VERSION_PROJECTION)
+        if current is None:
+            _AGENT_CACHE.pop(agent_id, None)
+            return None
+        if _version_of(current) == cached[0]:
+            _AGENT_CACHE.move_to_end(agent_id)
+            return cached[1]
+
+    agent = await agent_collection.find_one({"_id": ObjectId(agent_id)})
+    if agent is None:
+        _AGENT_CACHE.pop(agent_id, None)
+        return None
+
+    _AGENT_CACHE[agent_id] = (_version_of(agent), agent)
+    _AGENT_CACHE.move_to_end(agent_id)
+    while len(_AGENT_CACHE) > settings.AGENT_CACHE_MAX_SIZE:
+        _AGENT_CACHE.popitem(last=False)
+    return agent
+
+def peek_agent(agent_id: str) -> Optional[Dict[str, Any]]:
+    """只讀取記憶體中已快取的 Agent 文件 (不查詢資料庫、不檢查是否過期)，沒有快取時回傳 None"""
+    cached = _AGENT_CACHE.get(agent_id)
+    return cached[1] if cached else None
+
+def invalidate_agent(agent_id: str):
+    """Agent 文件被修改後呼叫，讓下次讀取取得最新設定"""
+    _AGENT_CACHE.pop(str(agent_id), None)
@@ -1,47 +1,55 @@
 import os
+import copy
 import json
 import asyncio
 import uuid
-from google.adk import Runner
-from google.adk.agents.run_config import RunConfig
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.events import Event, EventActions
 from adk_mongodb_session.mongodb.sessions.mongodb_session_service import MongodbSessionService
+from adk_mongodb_session.mongodb.sessions.session_cache import SessionCache
+from adk_mongodb_session.mongodb.sessions.session_lease import SessionLeaseTimeout
 from google.genai import types
 from google import genai
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 import logging
 from bson import ObjectId
+from pydantic import ValidationError
 
 from app.core.config import settings
-from app.core.database import agent_collection, user_collection, session_collection, chat_collection, used_token_collection, subagent_collection, daily_usage_collection
+from app.core.database import async_client, agent_collection, session_collection, chat_collection, used_token_collection
 from app.models.schemas import ChatStructuredOutput
-from app.agents.bot_agents import main_agent
+from app.agents.bot_agents import notify_human_support, CHAT_ENGINE_MULTI_AGENT, CHAT_ENGINE_SINGLE_PASS, CHAT_ENGINE_PARALLEL, CHAT_ENGINES, EXPERT_AGENT_NAMES, HANDOFF_REPLY_TEXT
 from app.prompts.templates import (
     FAQ_INSTRUCTION_HEADER, 
     SUBAGENT_INSTRUCTION, 
     HANDOFF_INSTRUCTION_HEADER, 
-    HANDOFF_DISABLED_INSTRUCTION
+    HANDOFF_DISABLED_INSTRUCTION,
+    SINGLE_PASS_INSTRUCTION,
+    PARALLEL_ROUTER_INSTRUCTION
 )
 from datetime import datetime, timedelta, time
 from zoneinfo import ZoneInfo
-from app.services.usage_service import check_usage_limit, record_usage
+from app.services.usage_service import get_usage_count, DAILY_LIMIT
+from app.services.chat_context import load_chat_context
+from app.services import agent_cache, subagent_registry, transcript_writer, usage_ledger, runner_registry, faq_index, handoff_matcher
 import re
+from dataclasses import asdict
 
 TAIPEI_TZ = ZoneInfo("Asia/Taipei")
 
 # 1. 初始化全域服務 (使用 MongoDB)
+# 共用 app.core.database 的非同步連線池，避免阻塞 event loop
 session_service = MongodbSessionService(
-    db_url=settings.MONGO_DB_URL,
+    db_url=None,
     database=settings.MONGO_DB_NAME,
-    collection_prefix=settings.MONGO_COLLECTION_PREFIX
+    collection_prefix=settings.MONGO_COLLECTION_PREFIX,
+    client=async_client,
+    default_event_window=settings.SESSION_EVENT_WINDOW,
+    session_cache=SessionCache(revalidate_after=settings.SESSION_CACHE_REVALIDATE_SECONDS or None),
+    lease_ttl=settings.SESSION_LEASE_TTL_SECONDS,
+    lease_wait_timeout=settings.SESSION_LEASE_WAIT_SECONDS
 )
 
-# 2. 初始化 Runner
-def get_runner(app_name: str):
-    return Runner(
-        agent=main_agent,
-        app_name=app_name,
-        session_service=session_service
-    )
 async def get_agents_by_admin(admin_id: str) -> List[Dict[str, Any]]:
     """取得該管理者的所有 Agent"""
     agents = []
@@ -68,13 +76,12 @@ async def get_agent_by_id(agent_id: str) -> Optional[Dict[str, Any]]:
                 if not id_to_status and used_list and isinstance(used_list[0], str):
                     id_to_status = {id_str: True for id_str in used_list}
                 
-                object_ids = [ObjectId(id_str) for id_str in id_to_status.keys() if id_str]
-                cursor = subagent_collection.find({"_id": {"$in": object_ids}})
-                async for sa in cursor:
-                    sa_id = str(sa["_id"])
-                    sa["_id"] = sa_id
-                    sa["enable"] = id_to_status.get(sa_id, True)
-                    details.append(sa)
+                await subagent_registry.ensure_loaded()
+                for sa_id, enable in id_to_status.items():
+                    sa = subagent_registry.get_by_id(sa_id) if sa_id else None
+                    if sa:
+                        sa["enable"] = enable
+                        details.append(sa)
             doc["used_subagent_details"] = details
             
         return doc
@@ -82,47 +89,42 @@ async def get_agent_by_id(agent_id: str) -> Optional[Dict[str, Any]]:
         print(f"Error in get_agent_by_id: {e}")
         return None
 
-async def clear_all_agent_sessions(agent_id: str):
-    """刪除該 Agent 的所有使用者對話紀錄，強迫下次對話時重新讀取最新設定"""
-    app_name = f"agent_{agent_id}"
-    
-    # 從我們管理的 session_collection 找出所有使用該 agent_id 的 session (只找未刪除的)
-    cursor = session_collection.find({"agent_id": agent_id, "deleted_at": None})
-    async for s in cursor:
-        try:
-            await session_service.delete_session(
-                app_name=app_name,
-                user_id=s["user_id"],
-                session_id=s["session_id"]
-            )
-        except Exception as e:
-            print(f"刪除 ADK Session 失敗 (可能已不存在): {e}")
-            
-    # 清除我們自己的紀錄 (軟刪除)
-    await session_collection.update_many(
-        {"agent_id": agent_id, "deleted_at": None},
-        {"$set": {"deleted_at": datetime.now(TAIPEI_TZ)}}
-    )
-    print(f"已清理 Agent {agent_id} 的所有舊 Session。")
+async def start_clear_agent_sessions(agent_id: str, admin_id: str) -> Optional[Dict[str, Any]]:
+    """以背景工作刪除該 Agent 的所有 ADK Session，並回傳工作進度"""
+    agent = await agent_collection.find_one({"_id": ObjectId(agent_id), "admin_id": admin_id}, {"_id": 1})
+    if not agent:
+        return None
+
+    # ADK Session 刪除後 (仍持有租約時) 才軟刪除我們自己的紀錄，後續訊息會建立新的 session 與紀錄；
+    # 正在對話中的 session 不會被刪除，紀錄也保留
+    async def soft_delete(session_ids: List[str]):
+        await session_collection.update_many(
+            {"session_id": {"$in": session_ids}, "deleted_at": None},
+            {"$set": {"deleted_at": datetime.now(TAIPEI_TZ)}}
+        )
+
+    job = await session_service.start_delete_sessions_job(app_name=f"agent_{agent_id}", on_deleted=soft_delete)
+    return asdict(job)
+
+async def get_clear_sessions_job(agent_id: str, admin_id: str, job_id: str) -> Optional[Dict[str, Any]]:
+    """取得批次刪除工作的進度 (進度存在資料庫，任何 worker 都能查詢)"""
+    agent = await agent_collection.find_one({"_id": ObjectId(agent_id), "admin_id": admin_id}, {"_id": 1})
+    if not agent:
+        return None
+    job = await session_service.get_delete_sessions_job(job_id)
+    if not job or job.app_name != f"agent_{agent_id}":
+        return None
+    return asdict(job)
 
 async def initialize_agent_system(config: dict, admin_line_user_id: str, agent_id: Optional[str] = None):
-    # 準備 FAQ 指令
-    faqs = config.get("faqs", [])
+    # 準備 FAQ 指令 (FAQ 不寫入指令，每輪對話由 faq_index 取出與問題相關的幾筆)
     faq_text = FAQ_INSTRUCTION_HEADER
-    index = 1
-    for item in faqs:
-        faq_text += f"\nid: {item.get('id')}\nQ{index}: {item.get('question')}\nA{index}: {item.get('answer')}\n\n"
-        index += 1
 
     # 準備路由指令
     handoff_logic = str(config.get("handoff_logic", "")).strip()
     # 獲取 Subagent 資訊以檢查手動開關
-    subagents_cursor = subagent_collection.find({})
-    subagent_map = {}
-    async for sa in subagents_cursor:
-        subagent_map[sa["name"]] = str(sa["_id"])
-    
-    em_id = subagent_map.get("Escalation Manager")
+    await subagent_registry.ensure_loaded()
+    em_id = subagent_registry.get_id("Escalation Manager")
     
     # 檢查 Escalation Manager 是否被手動關閉 (從現有的 agent 資料中讀取)
     em_enabled = True
@@ -186,6 +188,26 @@ async def initialize_agent_system(config: dict, admin_line_user_id: str, agent_i
 - 使用繁體中文回答
 """
 
+    # 單次呼叫模式的指令 (FAQ 同樣在每輪對話時依問題取出)
+    single_pass_prompt = SINGLE_PASS_INSTRUCTION.format(
+        tone=config.get('tone', '親切自然'),
+        tone_avoid_section=tone_avoid_section,
+        merchant_name=config.get('merchant_name', '未命名'),
+        services=config.get('services', '一般諮詢'),
+        handoff_section=(
+            f"""如果問題涉及"{handoff_logic}"，將 handoff_result.hand_off 設為 true 並說明原因。"""
+            if enable_handoff else "不提供轉接真人客服服務"
+        )
+    )
+
+    # 平行模式：faq_expert 與 handoff_expert 先同時執行，main_router 只負責彙整
+    parallel_router_prompt = PARALLEL_ROUTER_INSTRUCTION.format(
+        tone=config.get('tone', '親切自然'),
+        tone_avoid_section=tone_avoid_section,
+        merchant_name=config.get('merchant_name', '未命名'),
+        services=config.get('services', '一般諮詢')
+    )
+
     # 管理使用的 subagents
     # 如果已經存在，我們應該保留現有的 enable 狀態，只更新 id 清單
     existing_used = []
@@ -203,14 +225,13 @@ async def initialize_agent_system(config: dict, admin_line_user_id: str, agent_i
             
     used_subagent = []
     # Knowledge Base (客服專員) 永遠啟用 (除非未來有需求)
-    kb_id = subagent_map.get("Knowledge Base")
+    kb_id = subagent_registry.get_id("Knowledge Base")
     if kb_id:
         used_subagent.append({"id": kb_id, "enable": existing_status.get(kb_id, True)})
     
     # Escalation Manager (協作專員) 根據是否有轉接人工規則決定是否在清單中
     # 但它的 enable 狀態受手動開關與邏輯是否存在共同影響
     if handoff_logic:
-        em_id = subagent_map.get("Escalation Manager")
         if em_id:
             used_subagent.append({"id": em_id, "enable": existing_status.get(em_id, True)})
 
@@ -219,10 +240,18 @@ async def initialize_agent_system(config: dict, admin_line_user_id: str, agent_i
         "faq_instruction": faq_text.strip() + SUBAGENT_INSTRUCTION,
         "handoff_instruction": handoff_text+"\n-"+handoff_logic+SUBAGENT_INSTRUCTION if enable_handoff else handoff_text,
         "enable_handoff": enable_handoff,
+        "faq_retrieval": True,
+        "chat_engine": config.get("chat_engine", CHAT_ENGINE_MULTI_AGENT),
+        "single_pass_instruction": single_pass_prompt,
+        "parallel_router_instruction": parallel_router_prompt.strip(),
+        # 轉接規則為關鍵字清單時，供 handoff_matcher 在本地比對
+        "handoff_triggers": handoff_matcher.parse_triggers(handoff_logic) if enable_handoff else None,
+        # 訊息與轉接關鍵字完全無關時是否略過 handoff_expert (預設關閉，一律交給模型判斷)
+        "handoff_skip_on_miss": bool(config.get("handoff_skip_on_miss", False)),
         "raw_config": config
     }
     
-    # 儲存或更新 Agent 設定到 MongoDB
+    # 儲存或更新 Agent 設定到 MongoDB (config_version 遞增，讓快取的 Runner 與 FAQ 索引重建)
     if agent_id:
         await agent_collection.update_one(
             {"_id": ObjectId(agent_id), "admin_id": admin_line_user_id},
@@ -231,24 +260,27 @@ async def initialize_agent_system(config: dict, admin_line_user_id: str, agent_i
                     "config": user_config_data,
                     "used_subagent": used_subagent,
                     "updated_at": datetime.now(TAIPEI_TZ)
-                }
+                },
+                "$inc": {"config_version": 1}
             }
         )
-        # 商家更新設定時，清除所有舊的對話紀錄以確保同步
-        await clear_all_agent_sessions(agent_id)
+        agent_cache.invalidate_agent(agent_id)
+        runner_registry.invalidate(agent_id)
+        # 不再刪除舊的對話紀錄：各 session 會在下一輪對話時改用最新的設定版本
     else:
         # 新增
         result = await agent_collection.insert_one({
             "admin_id": admin_line_user_id,
             "name": config.get('merchant_name', '未命名 Agent'),
             "config": user_config_data,
+            "config_version": 1,
             "used_subagent": used_subagent,
             "created_at": datetime.now(TAIPEI_TZ),
             "updated_at": datetime.now(TAIPEI_TZ)
         })
         agent_id = str(result.inserted_id)
     
-    print(f"Agent {agent_id} 系統已更新，已清除所有關聯 Session。")
+    print(f"Agent {agent_id} 系統已更新，既有 Session 將於下一輪對話套用新設定。")
     return agent_id
 
 
@@ -268,88 +300,147 @@ async def run_chat(
     :param session_id: 這次對話的 Session ID (UUID)
     :param user_name: 使用者名稱 (用於記錄 user collection)
     """
+    result = {}
+    async for frame in stream_chat(
+        user_message,
+        line_user_id,
+        agent_id=agent_id,
+        session_id=session_id,
+        user_name=user_name,
+        source=source,
+        streaming=False
+    ):
+        if frame["type"] == "final":
+            result = {k: v for k, v in frame.items() if k != "type"}
+    return result
+
+def _final_frame(result: dict) -> dict:
+    return {"type": "final", **result}
+
+def _event_text(event) -> str:
+    text = ""
+    if hasattr(event, 'text') and event.text:
+        text += str(event.text)
+    elif hasattr(event, 'content') and event.content:
+        parts = getattr(event.content, 'parts', None) or []
+        for p in parts:
+            if hasattr(p, 'text') and p.text:
+                text += str(p.text)
+    return text
+
+async def _append_local_turn(session, content: types.Content, response_text: str, kind: str):
+    """沒有呼叫模型的回覆也寫入 ADK session，讓之後的對話仍能看到這一輪"""
+    invocation_id = f"{kind}-{uuid.uuid4()}"
+    await session_service.append_event(session, Event(invocation_id=invocation_id, author="user", content=content))
+    await session_service.append_event(session, Event(
+        invocation_id=invocation_id,
+        author="main_router",
+        content=types.Content(role="model", parts=[types.Part.from_text(text=response_text)])
+    ))
+
+# 舊版存放在 session state、現在改由 Agent 文件提供的指令與設定
+LEGACY_STATE_KEYS = ["router_instruction", "faq_instruction", "handoff_instruction", "raw_config", "enable_handoff"]
+
+# 單次呼叫模式輸出無法解析時的回覆
+SINGLE_PASS_FALLBACK_TEXT = "抱歉，系統暫時無法回覆，請稍後再試。"
+
+def _extract_response_text(output: str) -> Optional[str]:
+    """從格式不完整的輸出 (例如缺欄位或被截斷的 JSON) 取出 response_text"""
+    match = re.search(r'"response_text"\s*:\s*"((?:[^"\\]|\\.)*)"', output)
+    if not match:
+        return None
+    try:
+        text = json.loads(f'"{match.group(1)}"')
+    except json.JSONDecodeError:
+        return None
+    return text.strip() or None
+
+def _parse_single_pass_output(output: str):
+    """解析單次呼叫模式的 ChatStructuredOutput，格式錯誤時只取出 response_text，取不到則使用預設回覆"""
+    try:
+        result = ChatStructuredOutput.model_validate_json(output)
+    except ValidationError:
+        print("單次呼叫輸出格式錯誤:", output)
+        return _extract_response_text(output) or SINGLE_PASS_FALLBACK_TEXT, [], {}
+    return (
+        result.response_text,
+        [faq.model_dump() for faq in result.related_faq_list],
+        result.handoff_result.model_dump()
+    )
+
+async def stream_chat(
+    user_message: str,
+    line_user_id: str,
+    agent_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    user_name: Optional[str] = None,
+    source: Optional[str] = None,
+    streaming: bool = True,
+) -> AsyncIterator[dict]:
+    """
+    執行對話並逐步產生結果 (參數同 run_chat)
+    - {"type": "delta", "text": ...}: 回覆文字片段
+    - {"type": "tool", "name": ..., "status": "start" | "end"}: 子代理 (faq_expert、handoff_expert) 的呼叫進度
+    - {"type": "final", "response_text": ..., "related_faq_list": ..., "handoff_result": ...}: 最終結果，與 run_chat 的回傳相同
+    :param streaming: 是否讓模型以串流方式輸出，逐段產生文字片段
+    """
     if not agent_id:
-        return {"response_text": "尚未指定 Agent ID，請由商家完成設定。", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "No Agent ID"}}
+        yield _final_frame({"response_text": "尚未指定 Agent ID，請由商家完成設定。", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "No Agent ID"}})
+        return
 
     target_app_name = f"agent_{agent_id}"
     target_user_id = line_user_id
     target_session_id = session_id or str(uuid.uuid4())
-    
-    # 記錄或更新使用者資訊
-    await user_collection.update_one(
-        {"line_id": target_user_id},
-        {
-            "$set": {
-                "name": user_name or target_user_id,
-                "login_at": datetime.now(TAIPEI_TZ)
-            },
-            "$setOnInsert": {
-                "created_at": datetime.now(TAIPEI_TZ)
-            }
-        },
-        upsert=True
-    )
-
-    # 1. 檢查 Session Mode (只找未刪除的)
-    session_doc = await session_collection.find_one({
-        "session_id": target_session_id,
-        "deleted_at": None
-    })
-    if session_doc and session_doc.get("mode") == "human":
-        return {
-            "response_text": "現在由專員為您服務中。", 
-            "related_faq_list": [], 
-            "handoff_result": {"hand_off": True, "reason": "Already in human mode"}
-        }
 
     response_text = ""
+    context = None
+    lease = None
     try:
         content = types.Content(
             role="user",
             parts=[types.Part.from_text(text=user_message)]
         )
-        
-        # 1. 檢查 Session 是否存在
-        session = await session_service.get_session(
-            app_name=target_app_name, 
-            user_id=target_user_id, 
+
+        # 取得該 session 的租約，其他 worker 正在執行同一個 session 時等它結束
+        # (租約期間寫入的事件帶有租約編號，逾時被接手後舊的這輪無法再寫入)
+        lease = await session_service.acquire_session_lease(
+            app_name=target_app_name,
+            user_id=target_user_id,
             session_id=target_session_id
         )
         
-        # 獲取 Agent 配置
-        agent = await agent_collection.find_one({"_id": ObjectId(agent_id)})
-        if not agent:
-             return {"response_text": "找不到對應的 Agent 設定，請商家確認設定流程。", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "Agent not found"}}
-        
-        # 檢查管理員的使用限制
-        admin_id = agent.get("admin_id")
-        if not await check_usage_limit(admin_id):
-            return {
-                "response_text": "抱歉，該商家的今日 AI 使用額度已達上限 (100次)，請明天再試或聯繫商家。",
-                "related_faq_list": [],
-                "handoff_result": {"hand_off": False, "reason": "Monthly limit reached"}
-            }
-
-        if "config" not in agent:
-            return {"response_text": "找不到對應的 Agent 設定，請商家確認設定流程。", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "Agent Config not found"}}
-        
-        base_state = agent["config"].copy()
-        # 注入當前上下文到 state，供工具或指令引用
-        base_state["current_user_id"] = target_user_id
-        base_state["current_agent_id"] = agent_id
-        base_state["current_session_id"] = target_session_id
+        # 1. 同時載入使用者紀錄、Session 模式、ADK Session、Agent 設定與使用額度
+        context = await load_chat_context(
+            session_service,
+            agent_id=agent_id,
+            user_id=target_user_id,
+            session_id=target_session_id,
+            user_name=user_name
+        )
+        if context.rejection:
+            yield _final_frame(copy.deepcopy(context.rejection))
+            return
+        session = context.session
+        agent = context.agent
+
+        # 依商家設定的轉接關鍵字先在本地判斷 (明確命中直接轉接，完全無關則 handoff_expert 不呼叫模型)
+        handoff_verdict, handoff_keyword = handoff_matcher.classify_message(agent_id, agent, user_message)
+
+        # state 只保存 call_human_support 需要的上下文，指令由 runner_registry 依目前設定版本建立的代理提供
+        base_state = {
+            "current_user_id": target_user_id,
+            "current_agent_id": agent_id,
+            "current_session_id": target_session_id
+        }
         
         # 獲取 Subagent IDs 以便後續紀錄使用
-        subagents_cursor = subagent_collection.find({"name": {"$in": ["Knowledge Base", "Escalation Manager"]}})
-        subagent_id_map = {}
-        async for sa in subagents_cursor:
-            subagent_id_map[sa["name"]] = str(sa["_id"])
-        kb_id = subagent_id_map.get("Knowledge Base")
-        em_id = subagent_id_map.get("Escalation Manager")
+        await subagent_registry.ensure_loaded()
+        kb_id = subagent_registry.get_id("Knowledge Base")
+        em_id = subagent_registry.get_id("Escalation Manager")
         
         if not session:
             # 2. 如果不存在，建立新的
-            await session_service.create_session(
+            session = await session_service.create_session(
                 app_name=target_app_name, 
                 user_id=target_user_id, 
                 session_id=target_session_id,
@@ -374,27 +465,113 @@ async def run_chat(
                 upsert=True
             )
         else:
-            # 3. 如果已存在，更新 state (確保上下文與指令是最新的)
-            session.state.update(base_state)
-
-        # 記錄使用者訊息
-        user_chat_res = await chat_collection.insert_one({
+            # 舊版寫入 session state 的指令與設定已不再使用，移除以免每次載入都讀取、複製這些資料
+            await session_service.unset_session_state(session, LEGACY_STATE_KEYS)
+
+            # 3. 如果已存在且設定版本或上下文有變，寫回 state，讓本輪對話改用最新設定
+            changed_state = {k: v for k, v in base_state.items() if session.state.get(k) != v}
+            if changed_state:
+                await session_service.append_event(
+                    session,
+                    Event(
+                        invocation_id=f"config-{uuid.uuid4()}",
+                        author="user",
+                        actions=EventActions(state_delta=changed_state)
+                    )
+                )
+
+        # 記錄使用者訊息 (背景寫入)
+        await transcript_writer.enqueue_insert(chat_collection, {
+            "_id": ObjectId(),
             "session_id": target_session_id,
             "content": user_message,
             "sender": "user",
             "created_at": datetime.now(TAIPEI_TZ),
             "subagent_usage": []
         })
-        user_chat_id = str(user_chat_res.inserted_id)
+
+        # 問題與某筆 FAQ 幾乎相同時直接回覆 FAQ 答案，不呼叫模型
+        faq_hit = faq_index.match_faq(agent_id, agent, user_message)
+        if faq_hit:
+            response_text = faq_hit.get("answer", "")
+            related_faq_list = [{"id": faq_hit.get("id"), "Q": faq_hit.get("question"), "A": response_text}]
+            handoff_result = {"hand_off": False, "reason": "使用者問題不符合設定的轉接真人客服條件"}
+
+            await _append_local_turn(session, content, response_text, "faq")
+            await transcript_writer.enqueue_insert(chat_collection, {
+                "_id": ObjectId(),
+                "session_id": target_session_id,
+                "content": response_text,
+                "sender": "ai",
+                "created_at": datetime.now(TAIPEI_TZ),
+                "subagent_usage": [kb_id] if kb_id else [],
+                # 由 FAQ 比對直接回覆，沒有呼叫模型 (不記錄 token 也不計入每日使用次數)
+                "faq_fast_path": True
+            })
+            print("FAQ 直接回覆:", faq_hit.get("id"))
+
+            yield {"type": "delta", "text": response_text}
+            yield _final_frame({
+                "response_text": response_text,
+                "related_faq_list": related_faq_list,
+                "handoff_result": handoff_result
+            })
+            return
+
+        # 明確提到轉接關鍵字時直接轉接真人客服，不呼叫模型
+        if handoff_verdict == handoff_matcher.HIT:
+            yield {"type": "tool", "name": "call_human_support", "status": "start"}
+            notify_result = await notify_human_support(target_user_id, agent_id, target_session_id, user_message)
+            yield {"type": "tool", "name": "call_human_support", "status": "end"}
+            if notify_result.get("text") == "已轉接真人客服":
+                response_text = HANDOFF_REPLY_TEXT
+                handoff_result = {"hand_off": True, "reason": f"使用者提到轉接關鍵字：{handoff_keyword}"}
+            else:
+                response_text = notify_result.get("text", "")
+                handoff_result = {"hand_off": False, "reason": notify_result.get("text", "")}
+
+            await _append_local_turn(session, content, response_text, "handoff")
+            await transcript_writer.enqueue_insert(chat_collection, {
+                "_id": ObjectId(),
+                "session_id": target_session_id,
+                "content": response_text,
+                "sender": "ai",
+                "created_at": datetime.now(TAIPEI_TZ),
+                "subagent_usage": [em_id] if em_id else [],
+                # 由關鍵字比對直接轉接，沒有呼叫模型
+                "handoff_keyword": handoff_keyword
+            })
+            print("關鍵字直接轉接:", handoff_keyword)
+
+            yield {"type": "delta", "text": response_text}
+            yield _final_frame({
+                "response_text": response_text,
+                "related_faq_list": [],
+                "handoff_result": handoff_result
+            })
+            return
 
         # 3. 執行對話
-        runner = get_runner(target_app_name)
+        # 使用該 Agent 目前設定版本的 Runner (已快取)
+        runner = runner_registry.get_runner(agent_id, agent, session_service)
+        # 轉接關鍵字的判斷只屬於這一則訊息，不放進 session state (每輪執行前都會重新設定)
+        handoff_matcher.current_verdict.set(handoff_verdict)
+        # 單次呼叫模式的模型輸出為 ChatStructuredOutput JSON，解析後才送出回覆文字
+        single_pass = agent["config"].get("chat_engine") == CHAT_ENGINE_SINGLE_PASS
+        # 平行模式的 handoff_expert 只回傳判斷結果，轉接由本輪結束後決定
+        # (設定中沒有 parallel_router_instruction 的舊版本會改用多代理，見 build_configured_agent)
+        parallel = agent["config"].get("chat_engine") == CHAT_ENGINE_PARALLEL and "parallel_router_instruction" in agent["config"]
+        called_tools = set()
         usage_list = []
+        # 串流時模型會先送出多個 partial 片段，最後再送出一個完整的 event
+        streamed = False
+        experts_started = set()
         async for event in runner.run_async(
             user_id=target_user_id,
             session_id=target_session_id,
             new_message=content,
             run_config=RunConfig(
+                streaming_mode=StreamingMode.SSE if streaming else StreamingMode.NONE,
                 context_window_compression=types.ContextWindowCompressionConfig(
                     trigger_tokens=90000,  # 觸發壓縮的 token 數
                     sliding_window=types.SlidingWindow(
@@ -403,65 +580,77 @@ async def run_chat(
                 ),
             )
         ):
-            if hasattr(event, 'text') and event.text:
-                response_text += str(event.text)
-            elif hasattr(event, 'content') and event.content:
-                parts = getattr(event.content, 'parts', [])
-                for p in parts:
-                    if hasattr(p, 'text') and p.text:
-                        response_text += str(p.text)
+            text = _event_text(event)
+            # 平行模式中專家代理的輸出只寫入 state (faq_result / handoff_result)，不屬於回覆文字
+            expert = event.author if getattr(event, 'author', None) in EXPERT_AGENT_NAMES else None
+            if expert and expert not in experts_started:
+                experts_started.add(expert)
+                yield {"type": "tool", "name": expert, "status": "start"}
+
+            if getattr(event, 'partial', False):
+                if text and not single_pass and not expert:
+                    streamed = True
+                    yield {"type": "delta", "text": text}
+                continue
+
+            if expert:
+                if event.is_final_response():
+                    yield {"type": "tool", "name": expert, "status": "end"}
+            elif text:
+                response_text += text
+                # 已經以片段送出過的內容不再重複送出
+                if not streamed and not single_pass:
+                    yield {"type": "delta", "text": text}
+            streamed = False
+
+            for call in event.get_function_calls():
+                called_tools.add(call.name)
+                yield {"type": "tool", "name": call.name, "status": "start"}
+            for function_response in event.get_function_responses():
+                yield {"type": "tool", "name": function_response.name, "status": "end"}
             
             if hasattr(event, 'usage_metadata') and event.usage_metadata:
-                u = event.usage_metadata
-                input_tokens = getattr(u, 'prompt_token_count', 0)
-                output_tokens = getattr(u, 'candidates_token_count', 0)
-                thought_token = getattr(u, 'thoughts_token_count', 0)
-                tool_token = getattr(u, 'tool_use_prompt_token_count', 0)
-                total_token = getattr(u, 'total_token_count', 0)
-                
-                usage_list.append({
-                    "input_token": input_tokens,
-                    "output_token": output_tokens,
-                    "tool_token": tool_token,
-                    "thought_token": thought_token,
-                    "total_token": total_token
-                })
+                usage_list.append(event.usage_metadata)
                 
         print("-"*10)
         print("模型輸出:", response_text)
         print("-"*10)
 
-        session = await session_service.get_session(
-            app_name=target_app_name, 
-            user_id=target_user_id, 
-            session_id=target_session_id
-        )
-        state = session.state
-        faq_result = state.get('faq_result', [])
-        handoff_result = state.get('handoff_result', {})
-
-        # 處理模型可能回傳 Python Style 的布林值 (如 True 而非 true)
-        if isinstance(faq_result, str) and faq_result.strip():
-            try:
-                clean_faq = faq_result.replace("```json", "").replace("```", "")
-                clean_faq = clean_faq.replace(": True", ": true").replace(": False", ": false").replace(": None", ": null")
-                clean_faq = clean_faq.replace(":True", ":true").replace(":False", ":false").replace(":None", ":null")
-                faq_result = json.loads(clean_faq)
-                print("FAQ 格式正確")
-            except:
-                print("FAQ 格式錯誤，使用空 list")
-                faq_result = []
-
-        if isinstance(handoff_result, str) and handoff_result.strip():
-            try:
-                clean_handoff = handoff_result.replace("```json", "").replace("```", "")
-                clean_handoff = clean_handoff.replace(": True", ": true").replace(": False", ": false").replace(": None", ": null")
-                clean_handoff = clean_handoff.replace(":True", ":true").replace(":False", ":false").replace(":None", ":null")
-                handoff_result = json.loads(clean_handoff)
-                print("handoff_result 格式正確")
-            except:
-                print("handoff_result 格式錯誤，使用空 dict")
-                handoff_result = {}
+        if single_pass:
+            response_text, faq_result, handoff_result = _parse_single_pass_output(response_text)
+            yield {"type": "delta", "text": response_text}
+        else:
+            session = await session_service.get_session(
+                app_name=target_app_name, 
+                user_id=target_user_id, 
+                session_id=target_session_id
+            )
+            state = session.state
+            faq_result = state.get('faq_result', [])
+            handoff_result = state.get('handoff_result', {})
+
+            # 處理模型可能回傳 Python Style 的布林值 (如 True 而非 true)
+            if isinstance(faq_result, str) and faq_result.strip():
+                try:
+                    clean_faq = faq_result.replace("```json", "").replace("```", "")
+                    clean_faq = clean_faq.replace(": True", ": true").replace(": False", ": false").replace(": None", ": null")
+                    clean_faq = clean_faq.replace(":True", ":true").replace(":False", ":false").replace(":None", ":null")
+                    faq_result = json.loads(clean_faq)
+                    print("FAQ 格式正確")
+                except:
+                    print("FAQ 格式錯誤，使用空 list")
+                    faq_result = []
+
+            if isinstance(handoff_result, str) and handoff_result.strip():
+                try:
+                    clean_handoff = handoff_result.replace("```json", "").replace("```", "")
+                    clean_handoff = clean_handoff.replace(": True", ": true").replace(": False", ": false").replace(": None", ": null")
+                    clean_handoff = clean_handoff.replace(":True", ":true").replace(":False", ":false").replace(":None", ":null")
+                    handoff_result = json.loads(clean_handoff)
+                    print("handoff_result 格式正確")
+                except:
+                    print("handoff_result 格式錯誤，使用空 dict")
+                    handoff_result = {}
 
         # 判斷使用的 subagent
         used_subagent_ids = []
@@ -472,6 +661,10 @@ async def run_chat(
         else:
             related_faq_list = []
 
+        # 平行模式中 FAQ 已能回答時，不採用同時執行的 handoff_expert 判斷
+        if parallel and related_faq_list and "call_human_support" not in called_tools:
+            handoff_result = {}
+
         if isinstance(handoff_result, dict) and handoff_result.get("hand_off"):
             if em_id:
                 used_subagent_ids.append(em_id)
@@ -479,45 +672,61 @@ async def run_chat(
         else:
             handoff_result = {"hand_off": False, "reason": "使用者問題不符合設定的轉接真人客服條件"}
 
-        # 記錄 AI 回覆
-        ai_chat_res = await chat_collection.insert_one({
+        # 單次呼叫模式與平行模式的 handoff_expert 沒有 call_human_support tool，由這裡執行轉接
+        if (single_pass or parallel) and handoff_result.get("hand_off") and "call_human_support" not in called_tools:
+            await notify_human_support(target_user_id, agent_id, target_session_id, user_message)
+
+        # 以下紀錄皆由背景佇列寫入，回覆不需等待資料庫
+        # 記錄 AI 回覆 (先產生 _id 供 token 紀錄引用)
+        ai_chat_oid = ObjectId()
+        ai_chat_id = str(ai_chat_oid)
+        await transcript_writer.enqueue_insert(chat_collection, {
+            "_id": ai_chat_oid,
             "session_id": target_session_id,
             "content": response_text,
             "sender": "ai",
             "created_at": datetime.now(TAIPEI_TZ),
             "subagent_usage": used_subagent_ids
         })
-        ai_chat_id = str(ai_chat_res.inserted_id)
 
         # 記錄 Token 消耗
-        for usage in usage_list:
-            await used_token_collection.insert_one({
-                "chat_id": ai_chat_id,
-                "admin_id": agent.get("admin_id"),
-                "agent_id": agent_id,
-                "subagent_id": used_subagent_ids,
-                "session_id": target_session_id,
-                "model": settings.AGENT_MODEL,
-                "usage_type": "聊天",
-                "usage": usage,
-                "created_at": datetime.now(TAIPEI_TZ),
-                "input": user_message,
-                "output": response_text
-            })
+        for usage_metadata in usage_list:
+            await usage_ledger.record_llm_usage(
+                usage_metadata,
+                usage_type="聊天",
+                model=settings.AGENT_MODEL,
+                admin_id=agent.get("admin_id"),
+                agent_id=agent_id,
+                subagent_id=used_subagent_ids,
+                session_id=target_session_id,
+                chat_id=ai_chat_id,
+                input=user_message,
+                output=response_text
+            )
         
         # 記錄使用量 (token 消耗可能有多筆, 但只算使用一次)
-        await record_usage(agent.get("admin_id"))
+        context.reservation.commit()
 
-        return {
+        yield _final_frame({
             "response_text": response_text,
             "related_faq_list": related_faq_list,
             "handoff_result": handoff_result
-        }
+        })
                         
+    except SessionLeaseTimeout:
+        print(f"Session {target_session_id} 的前一輪對話尚未結束")
+        yield _final_frame({"response_text": "系統忙碌中，請稍後再試", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "系統忙碌"}})
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return {"response_text": f"對話發生錯誤: {e}", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "系統錯誤"}}
+        yield _final_frame({"response_text": f"對話發生錯誤: {e}", "related_faq_list": [], "handoff_result": {"hand_off": False, "reason": "系統錯誤"}})
+    finally:
+        # 沒有成功回覆時釋放預留的額度
+        if context and context.reservation:
+            context.reservation.release()
+        # 用戶端中斷連線時這裡可能被取消；租約的釋放不受取消影響，不會卡到租約逾時
+        if lease:
+            await session_service.release_session_lease(lease)
 
 async def get_available_subagents(agent_id: str) -> List[Dict[str, Any]]:
     """取得該 Agent 還沒使用的官方 subagents"""
@@ -526,19 +735,15 @@ async def get_available_subagents(agent_id: str) -> List[Dict[str, Any]]:
         return []
     
     used_list = agent.get("used_subagent", [])
-    used_ids = []
+    used_ids = set()
     for item in used_list:
         if isinstance(item, dict):
-            used_ids.append(ObjectId(item["id"]))
+            used_ids.add(item["id"])
         elif isinstance(item, str):
-            used_ids.append(ObjectId(item))
+            used_ids.add(item)
     
-    available = []
-    cursor = subagent_collection.find({"_id": {"$nin": used_ids}})
-    async for doc in cursor:
-        doc["_id"] = str(doc["_id"])
-        available.append(doc)
-    return available
+    await subagent_registry.ensure_loaded()
+    return [sa for sa in subagent_registry.list_all() if sa["_id"] not in used_ids]
 
 async def add_subagent_to_agent(agent_id: str, subagent_id: str):
     """將 subagent 加入 Agent 的使用清單"""
@@ -553,8 +758,12 @@ async def add_subagent_to_agent(agent_id: str, subagent_id: str):
     if not exists:
         result = await agent_collection.update_one(
             {"_id": ObjectId(agent_id)},
-            {"$addToSet": {"used_subagent": {"id": subagent_id, "enable": True}}}
+            {
+                "$addToSet": {"used_subagent": {"id": subagent_id, "enable": True}},
+                "$set": {"updated_at": datetime.now(TAIPEI_TZ)}
+            }
         )
+        agent_cache.invalidate_agent(agent_id)
         return result.modified_count > 0
     return True
 
@@ -586,8 +795,9 @@ async def toggle_subagent_enable(agent_id: str, admin_id: str, subagent_id: str,
     # 更新到資料庫
     await agent_collection.update_one(
         {"_id": ObjectId(agent_id)},
-        {"$set": {"used_subagent": new_used}}
+        {"$set": {"used_subagent": new_used, "updated_at": datetime.now(TAIPEI_TZ)}}
     )
+    agent_cache.invalidate_agent(agent_id)
 
     # 重新初始化系統以更新 prompt
     raw_config = agent.get("config", {}).get("raw_config", {})
@@ -605,7 +815,7 @@ async def update_agent_faqs(agent_id: str, admin_id: str, faqs: List[Dict[str, A
     # 加入後端驗證
     if not faqs:
         return False
-    if len(faqs) > 20:
+    if len(faqs) > settings.FAQ_MAX_COUNT:
         return False
     for faq in faqs:
         q = faq.get("question", "").strip()
@@ -640,10 +850,7 @@ async def update_agent_handoff(agent_id: str, admin_id: str, handoff_triggers: L
         custom_list = [t.strip() for t in handoff_custom.replace("、", ",").split(",") if t.strip()]
         all_triggers.extend(custom_list)
         
-    if all_triggers:
-        raw_config["handoff_logic"] = f"當使用者提到以下任何一項時轉接：{', '.join(all_triggers)}"
-    else:
-        raw_config["handoff_logic"] = ""
+    raw_config["handoff_logic"] = handoff_matcher.format_handoff_logic(all_triggers)
         
     await initialize_agent_system(raw_config, admin_id, agent_id)
     return True
@@ -703,11 +910,7 @@ async def get_agent_token_stats(agent_id: str, admin_id: str):
             "balance": 1250 # Placeholder, 實際應從帳戶餘額扣除
         })
 
-    today_usage_count = 0
-    today_str = now.strftime("%Y-%m-%d")
-    usage_doc = await daily_usage_collection.find_one({"admin_id": admin_id, "date": today_str})
-    if usage_doc:
-        today_usage_count = usage_doc.get("usage", 0)
+    today_usage_count = await get_usage_count(admin_id)
 
     return {
         "monthly_usage": {
@@ -718,7 +921,7 @@ async def get_agent_token_stats(agent_id: str, admin_id: str):
         "daily_stats": {
             "today_chats": today_chats,
             "today_usage_count": today_usage_count,
-            "usage_limit": 100,
+            "usage_limit": DAILY_LIMIT,
             "health_score": 100 # 目前預設為 100，未來可根據錯誤率計算
         },
         "history": history
@@ -747,13 +950,17 @@ async def update_agent_config(agent_id: str, admin_id: str, updates: Dict[str, A
     if "tone_avoid" in updates:
         if updates["tone_avoid"] and len(updates["tone_avoid"]) > 50: return False
         raw_config["tone_avoid"] = updates["tone_avoid"]
+    if "chat_engine" in updates:
+        if updates["chat_engine"] not in CHAT_ENGINES: return False
+        raw_config["chat_engine"] = updates["chat_engine"]
     
     # 同步更新 agent table 的 name
     if "merchant_name" in updates:
         await agent_collection.update_one(
             {"_id": ObjectId(agent_id)},
-            {"$set": {"name": updates["merchant_name"]}}
+            {"$set": {"name": updates["merchant_name"], "updated_at": datetime.now(TAIPEI_TZ)}}
         )
+        agent_cache.invalidate_agent(agent_id)
 
     await initialize_agent_system(raw_config, admin_id, agent_id)
     return True
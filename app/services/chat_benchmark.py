@@ -0,0 +1,127 @@
+"""
+比較各對話引擎 (多代理 / 單次呼叫 / 平行) 的延遲與 token 消耗
+
+在 backend 目錄下執行:
+    python -m app.services.chat_benchmark <agent_id> "營業時間?" "可以刷卡嗎?" --rounds 3
+
+使用該 Agent 目前的設定建立各引擎的代理，每個問題都在新的記憶體 session 中執行，
+不寫入 MongoDB、不記錄使用量，也不會真的轉接真人客服 (state 中沒有使用者資訊)。
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, Any, List
+
+from google.adk import Runner
+from google.adk.agents import BaseAgent, LlmAgent
+from google.adk.sessions import InMemorySessionService
+from google.adk.tools.agent_tool import AgentTool
+from google.genai import types
+
+from app.agents.bot_agents import (
+    build_configured_agent,
+    CHAT_ENGINE_MULTI_AGENT,
+    CHAT_ENGINES
+)
+from app.services import agent_cache
+from app.services.usage_ledger import usage_from_metadata
+
+APP_NAME = "chat_benchmark"
+
+def _track_model_calls(agent: BaseAgent, calls: List[Dict[str, int]]):
+    """
+    在代理樹的每個 LlmAgent 掛上 after_model_callback 記錄每次模型呼叫的 token
+    (faq_expert / handoff_expert 以 AgentTool 執行，它們的 event 不會出現在外層 Runner)
+    """
+    def after_model(callback_context, llm_response):
+        if llm_response.usage_metadata and not llm_response.partial:
+            calls.append(usage_from_metadata(llm_response.usage_metadata))
+        return None
+
+    if isinstance(agent, LlmAgent):
+        agent.after_model_callback = after_model
+        for tool in agent.tools:
+            if isinstance(tool, AgentTool):
+                _track_model_calls(tool.agent, calls)
+    for sub_agent in agent.sub_agents:
+        _track_model_calls(sub_agent, calls)
+
+async def _run_once(runner: Runner, calls: List[Dict[str, int]], question: str) -> Dict[str, Any]:
+    session = await runner.session_service.create_session(app_name=APP_NAME, user_id="benchmark")
+    calls.clear()
+    started = time.perf_counter()
+    async for _ in runner.run_async(
+        user_id="benchmark",
+        session_id=session.id,
+        new_message=types.Content(role="user", parts=[types.Part.from_text(text=question)])
+    ):
+        pass
+    return {
+        "latency": time.perf_counter() - started,
+        "model_calls": len(calls),
+        "input_token": sum(c["input_token"] for c in calls),
+        "output_token": sum(c["output_token"] for c in calls),
+        "total_token": sum(c["total_token"] for c in calls)
+    }
+
+def _summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    latencies = sorted(r["latency"] for r in results)
+    return {
+        "runs": len(results),
+        "latency_avg": statistics.mean(latencies),
+        "latency_p50": statistics.median(latencies),
+        "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "model_calls_avg": statistics.mean(r["model_calls"] for r in results),
+        "input_token_avg": statistics.mean(r["input_token"] for r in results),
+        "output_token_avg": statistics.mean(r["output_token"] for r in results),
+        "total_token_avg": statistics.mean(r["total_token"] for r in results)
+    }
+
+async def run_benchmark(agent_id: str, questions: List[str], rounds: int = 1) -> Dict[str, Dict[str, Any]]:
+    """以相同的問題分別測試各對話引擎，回傳 {engine: 統計結果}"""
+    agent = await agent_cache.get_agent(agent_id)
+    if not agent or "config" not in agent:
+        raise ValueError(f"Agent {agent_id} 不存在或尚未設定")
+    if "parallel_router_instruction" not in agent["config"]:
+        raise ValueError("此 Agent 的設定版本過舊，請重新儲存設定後再測試")
+
+    report = {}
+    for engine in CHAT_ENGINES:
+        config = {**agent["config"], "chat_engine": engine}
+        tree = build_configured_agent(agent_id, agent.get("config_version", 0), config)
+        calls: List[Dict[str, int]] = []
+        _track_model_calls(tree, calls)
+        runner = Runner(agent=tree, app_name=APP_NAME, session_service=InMemorySessionService())
+
+        results = []
+        for _ in range(rounds):
+            for question in questions:
+                results.append(await _run_once(runner, calls, question))
+        report[engine] = _summarize(results)
+    return report
+
+def _print_report(report: Dict[str, Dict[str, Any]]):
+    print(f"{'engine':<14}{'runs':>6}{'avg(s)':>9}{'p50(s)':>9}{'p95(s)':>9}{'calls':>7}{'in_tok':>9}{'out_tok':>9}{'total':>9}")
+    for engine, r in report.items():
+        print(
+            f"{engine:<14}{r['runs']:>6}{r['latency_avg']:>9.2f}{r['latency_p50']:>9.2f}{r['latency_p95']:>9.2f}"
+            f"{r['model_calls_avg']:>7.1f}{r['input_token_avg']:>9.0f}{r['output_token_avg']:>9.0f}{r['total_token_avg']:>9.0f}"
+        )
+    multi = report.get(CHAT_ENGINE_MULTI_AGENT)
+    if not multi or not multi["latency_avg"] or not multi["total_token_avg"]:
+        return
+    for engine, r in report.items():
+        if engine != CHAT_ENGINE_MULTI_AGENT:
+            print(
+                f"{engine} / {CHAT_ENGINE_MULTI_AGENT}: 延遲 {r['latency_avg'] / multi['latency_avg']:.0%}，"
+                f"token {r['total_token_avg'] / multi['total_token_avg']:.0%}"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比較各對話引擎的延遲與 token 消耗")
+    parser.add_argument("agent_id")
+    parser.add_argument("questions", nargs="+")
+    parser.add_argument("--rounds", type=int, default=1)
+    args = parser.parse_args()
+    _print_report(asyncio.run(run_benchmark(args.agent_id, args.questions, args.rounds)))
@@ -0,0 +1,123 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Dict, Any
+from zoneinfo import ZoneInfo
+
+from google.adk.sessions import BaseSessionService, Session
+from google.adk.sessions.base_session_service import GetSessionConfig
+
+from app.core.database import user_collection, session_collection
+from app.services import agent_cache
+from app.services.usage_service import reserve_usage, UsageReservation
+
+TAIPEI_TZ = ZoneInfo("Asia/Taipei")
+
+HUMAN_MODE_RESPONSE = {
+    "response_text": "現在由專員為您服務中。",
+    "related_faq_list": [],
+    "handoff_result": {"hand_off": True, "reason": "Already in human mode"}
+}
+AGENT_NOT_FOUND_RESPONSE = {
+    "response_text": "找不到對應的 Agent 設定，請商家確認設定流程。",
+    "related_faq_list": [],
+    "handoff_result": {"hand_off": False, "reason": "Agent not found"}
+}
+AGENT_CONFIG_NOT_FOUND_RESPONSE = {
+    "response_text": "找不到對應的 Agent 設定，請商家確認設定流程。",
+    "related_faq_list": [],
+    "handoff_result": {"hand_off": False, "reason": "Agent Config not found"}
+}
+USAGE_LIMIT_RESPONSE = {
+    "response_text": "抱歉，該商家的今日 AI 使用額度已達上限 (100次)，請明天再試或聯繫商家。",
+    "related_faq_list": [],
+    "handoff_result": {"hand_off": False, "reason": "Monthly limit reached"}
+}
+
+@dataclass
+class ChatContext:
+    """run_chat 在呼叫模型前需要的資料"""
+    agent: Optional[Dict[str, Any]] = None
+    session: Optional[Session] = None
+    # 本次對話預留的使用額度，呼叫模型成功後 commit
+    reservation: Optional[UsageReservation] = None
+    # 不為 None 時代表這次對話不需呼叫模型，直接回傳此內容
+    rejection: Optional[Dict[str, Any]] = None
+
+async def _upsert_user(user_id: str, user_name: Optional[str]):
+    await user_collection.update_one(
+        {"line_id": user_id},
+        {
+            "$set": {
+                "name": user_name or user_id,
+                "login_at": datetime.now(TAIPEI_TZ)
+            },
+            "$setOnInsert": {
+                "created_at": datetime.now(TAIPEI_TZ)
+            }
+        },
+        upsert=True
+    )
+
+async def _check_mode(session_id: str) -> Optional[Dict[str, Any]]:
+    # 只找未刪除的
+    session_doc = await session_collection.find_one(
+        {"session_id": session_id, "deleted_at": None},
+        {"mode": 1}
+    )
+    if session_doc and session_doc.get("mode") == "human":
+        return HUMAN_MODE_RESPONSE
+    return None
+
+async def _load_agent(agent_id: str):
+    agent = await agent_cache.get_agent(agent_id)
+    if not agent:
+        return agent, None, AGENT_NOT_FOUND_RESPONSE
+    # 預留管理員的使用額度 (額度用完的回覆優先於找不到設定)
+    reservation = await reserve_usage(agent.get("admin_id"))
+    if reservation is None:
+        return agent, None, USAGE_LIMIT_RESPONSE
+    if "config" not in agent:
+        reservation.release()
+        return agent, None, AGENT_CONFIG_NOT_FOUND_RESPONSE
+    return agent, reservation, None
+
+async def _load_session(session_service: BaseSessionService, agent_id: str, user_id: str, session_id: str):
+    # 依該 Agent 的對話歷史載入範圍讀取；Agent 尚未快取時不等待 Agent 查詢，直接以 session service 的預設值同時讀取
+    agent = agent_cache.peek_agent(agent_id)
+    window = agent.get("session_event_window") if agent else None
+    config = GetSessionConfig(num_recent_events=window) if window else None
+    return await session_service.get_session(app_name=f"agent_{agent_id}", user_id=user_id, session_id=session_id, config=config)
+
+async def load_chat_context(
+    session_service: BaseSessionService,
+    agent_id: str,
+    user_id: str,
+    session_id: str,
+    user_name: Optional[str] = None,
+) -> ChatContext:
+    """
+    同時執行對話前的各項查詢 (使用者紀錄、session 模式、Agent 設定與額度、ADK session)
+    全部完成後依固定順序決定是否不需呼叫模型：真人模式 > 找不到 Agent > 額度用完 > 找不到設定
+    """
+    context = ChatContext()
+    agent_task = asyncio.create_task(_load_agent(agent_id))
+    completed = False
+    try:
+        _, mode_rejection, context.session = await asyncio.gather(
+            _upsert_user(user_id, user_name),
+            _check_mode(session_id),
+            _load_session(session_service, agent_id, user_id, session_id)
+        )
+        context.agent, context.reservation, agent_rejection = await agent_task
+        context.rejection = mode_rejection or agent_rejection
+        completed = True
+    finally:
+        if not agent_task.done():
+            agent_task.cancel()
+        elif not completed and not agent_task.cancelled() and agent_task.exception() is None:
+            context.reservation = agent_task.result()[1]
+        # 不會呼叫模型時釋放預留的額度
+        if context.reservation and (not completed or context.rejection is not None):
+            context.reservation.release()
+    return context
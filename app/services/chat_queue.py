@@ -0,0 +1,93 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Awaitable, Optional, Dict, Any, List
+
+from app.core.config import settings
+
+RunTurn = Callable[[str], Awaitable[Dict[str, Any]]]
+
+@dataclass
+class _Pending:
+    message: str
+    run: RunTurn
+    future: asyncio.Future
+    arrived_at: float = field(default_factory=time.monotonic)
+
+# session_id -> 等待處理的訊息；有訊息時該 session 會有一個 worker 依序處理
+_pending: Dict[str, List[_Pending]] = {}
+_workers: Dict[str, asyncio.Task] = {}
+
+async def submit(session_id: str, message: str, run: RunTurn) -> Optional[Dict[str, Any]]:
+    """
+    將訊息排入該 session 的佇列，同一個 session 一次只執行一輪對話
+    短時間內 (CHAT_COALESCE_SECONDS) 連續送出的訊息會合併成一輪，以最後一則訊息的 run 執行
+    一輪最多合併 CHAT_COALESCE_MAX_MESSAGES 則、CHAT_COALESCE_MAX_CHARS 字，其餘訊息留到下一輪
+    :param run: 以合併後的訊息執行對話的函式 (通常會帶著該則訊息的 reply token)
+    :return: 這一輪的結果；訊息被併入之後的訊息時回傳 None (由最後一則訊息的呼叫端回覆)
+    """
+    future = asyncio.get_running_loop().create_future()
+    _pending.setdefault(session_id, []).append(_Pending(message, run, future))
+    if session_id not in _workers:
+        _workers[session_id] = asyncio.create_task(_worker(session_id))
+    return await future
+
+async def _wait_for_quiet(session_id: str):
+    """等到 CHAT_COALESCE_SECONDS 內沒有新訊息，最多等到第一則訊息後 CHAT_COALESCE_MAX_SECONDS"""
+    batch = _pending[session_id]
+    deadline = batch[0].arrived_at + settings.CHAT_COALESCE_MAX_SECONDS
+    while True:
+        # 已達一輪的則數上限時不必再等
+        if len(batch) >= settings.CHAT_COALESCE_MAX_MESSAGES:
+            return
+        now = time.monotonic()
+        wait = min(batch[-1].arrived_at + settings.CHAT_COALESCE_SECONDS, deadline) - now
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+def _take_batch(session_id: str) -> List[_Pending]:
+    """取出這一輪要合併的訊息 (不超過則數與字數上限)，其餘留在佇列中"""
+    pending = _pending.pop(session_id)
+    batch = []
+    length = 0
+    for item in pending:
+        if batch and (
+            len(batch) >= settings.CHAT_COALESCE_MAX_MESSAGES
+            or length + len(item.message) > settings.CHAT_COALESCE_MAX_CHARS
+        ):
+            break
+        batch.append(item)
+        length += len(item.message) + 1
+    if len(batch) < len(pending):
+        _pending[session_id] = pending[len(batch):]
+    return batch
+
+async def _worker(session_id: str):
+    try:
+        while _pending.get(session_id):
+            await _wait_for_quiet(session_id)
+            batch = _take_batch(session_id)
+            latest = batch[-1]
+            merged = "\n".join(item.message for item in batch if item.message)
+            merged = merged[:settings.CHAT_COALESCE_MAX_CHARS]
+            try:
+                result = await latest.run(merged)
+            except Exception as e:
+                # 只讓負責回覆的最後一則訊息收到例外 (錯誤只記錄一次)，其餘視為已併入
+                for item in batch[:-1]:
+                    if not item.future.done():
+                        item.future.set_result(None)
+                if not latest.future.done():
+                    latest.future.set_exception(e)
+                continue
+            for item in batch[:-1]:
+                if not item.future.done():
+                    item.future.set_result(None)
+            if not latest.future.done():
+                latest.future.set_result(result)
+    finally:
+        _workers.pop(session_id, None)
+        # worker 結束前剛好有新訊息排入時，重新啟動 worker
+        if _pending.get(session_id) and session_id not in _workers:
+            _workers[session_id] = asyncio.create_task(_worker(session_id))
@@ -0,0 +1,157 @@
+import math
+import re
+import unicodedata
+import heapq
+from collections import Counter, OrderedDict, defaultdict
+from typing import Optional, Dict, Any, List, Tuple
+
+from app.core.config import settings
+from app.prompts.templates import FAQ_INSTRUCTION_HEADER, SUBAGENT_INSTRUCTION
+
+# 中文沒有空白斷詞，以單字與相鄰兩字 (character n-gram) 作為比對單位
+NGRAM_SIZES = (1, 2)
+_NON_WORD = re.compile(r"[\W_]+")
+
+def normalize(text: str) -> str:
+    """全形轉半形、英文轉小寫並移除標點與空白"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _NON_WORD.sub("", text)
+
+# 不影響問題語意的語助詞與客套詞，判斷「幾乎相同」時忽略
+_FILLER_PHRASES = ("請問", "想問", "我想", "一下")
+_FILLER_CHARS = re.compile(r"[嗎呢吧啊呀喔哦啦耶唷]")
+
+def _core(text: str) -> str:
+    """正規化後去掉語助詞與客套詞，剩下決定語意的字"""
+    text = normalize(text)
+    for phrase in _FILLER_PHRASES:
+        text = text.replace(phrase, "")
+    return _FILLER_CHARS.sub("", text)
+
+def is_near_verbatim(query: str, question: str) -> bool:
+    """
+    問題與 FAQ 是否只差語助詞等不影響語意的幾個字
+    換字 (退款/退貨)、加字 (週末)、否定 (不可以) 都視為不同問題
+    """
+    extra = abs(len(normalize(query)) - len(normalize(question)))
+    return extra <= settings.FAQ_FAST_PATH_MAX_EXTRA_CHARS and _core(query) == _core(question)
+
+def ngrams(text: str) -> Counter:
+    text = normalize(text)
+    grams = Counter()
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            grams[text[i:i + n]] += 1
+    return grams
+
+class FaqIndex:
+    """
+    單一 Agent 的 FAQ 索引 (以問題文字建立)
+    使用 TF-IDF 加權的 n-gram 向量與倒排索引計算餘弦相似度，只需掃過與查詢有共同 n-gram 的 FAQ
+    """
+    def __init__(self, faqs: List[Dict[str, Any]], previous: Optional["FaqIndex"] = None):
+        """
+        :param previous: 同一個 Agent 前一版的索引；問題文字沒變的 FAQ 沿用其 n-gram，編輯少數幾筆時只需重新切分這幾筆
+        """
+        self.faqs = [faq for faq in faqs if normalize(faq.get("question", ""))]
+        known = previous._grams_by_question if previous else {}
+        self._grams_by_question: Dict[str, Counter] = {}
+        grams_list = []
+        for faq in self.faqs:
+            question = faq["question"]
+            grams = self._grams_by_question.get(question) or known.get(question) or ngrams(question)
+            self._grams_by_question[question] = grams
+            grams_list.append(grams)
+
+        doc_freq = Counter()
+        for grams in grams_list:
+            doc_freq.update(grams.keys())
+        total = len(self.faqs)
+        self._idf = {gram: math.log((1 + total) / (1 + df)) + 1 for gram, df in doc_freq.items()}
+        # 查詢中出現、但所有 FAQ 都沒有的 n-gram 視為最稀有
+        self._unseen_idf = math.log(1 + total) + 1
+
+        self._postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        self._exact: Dict[str, int] = {}
+        for i, grams in enumerate(grams_list):
+            for gram, weight in self._unit_vector(grams, self._idf).items():
+                self._postings[gram].append((i, weight))
+            self._exact.setdefault(normalize(self.faqs[i]["question"]), i)
+
+    def __len__(self) -> int:
+        return len(self.faqs)
+
+    def _unit_vector(self, grams: Counter, idf: Dict[str, float]) -> Dict[str, float]:
+        vector = {gram: count * idf.get(gram, self._unseen_idf) for gram, count in grams.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {gram: w / norm for gram, w in vector.items()}
+
+    def search(self, query: str, k: int = 1) -> List[Tuple[float, Dict[str, Any]]]:
+        """回傳與查詢最相似的 k 筆 FAQ 與相似度 (0~1)，由高到低排列"""
+        exact = self._exact.get(normalize(query))
+        if exact is not None and k == 1:
+            return [(1.0, self.faqs[exact])]
+
+        scores: Dict[int, float] = defaultdict(float)
+        for gram, weight in self._unit_vector(ngrams(query), self._idf).items():
+            for i, doc_weight in self._postings.get(gram, ()):
+                scores[i] += weight * doc_weight
+        if exact is not None:
+            scores[exact] = 1.0
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(min(score, 1.0), self.faqs[i]) for i, score in best]
+
+def format_faqs(faqs: List[Dict[str, Any]]) -> str:
+    text = ""
+    for index, item in enumerate(faqs, start=1):
+        text += f"\nid: {item.get('id')}\nQ{index}: {item.get('question')}\nA{index}: {item.get('answer')}\n\n"
+    return text
+
+# agent_id -> (設定版本, FaqIndex)；設定更新後以新版本重建 (沿用前一版未變動的部分)
+MAX_CACHED_INDEXES = 512
+_INDEXES: "OrderedDict[str, tuple]" = OrderedDict()
+
+def get_index(agent_id: str, version: int, config: Dict[str, Any]) -> FaqIndex:
+    """取得某個設定版本的 FAQ 索引"""
+    cached = _INDEXES.get(agent_id)
+    if cached and cached[0] == version:
+        _INDEXES.move_to_end(agent_id)
+        return cached[1]
+
+    raw_config = config.get("raw_config", {})
+    index = FaqIndex(raw_config.get("faqs", []), previous=cached[1] if cached else None)
+    _INDEXES[agent_id] = (version, index)
+    _INDEXES.move_to_end(agent_id)
+    while len(_INDEXES) > MAX_CACHED_INDEXES:
+        _INDEXES.popitem(last=False)
+    return index
+
+def match_faq(agent_id: str, agent: Dict[str, Any], query: str) -> Optional[Dict[str, Any]]:
+    """
+    使用者問題與某筆 FAQ 幾乎一字不差時回傳該 FAQ，否則回傳 None (交給模型搭配最相關的幾筆 FAQ 回答)
+    除了相似度須達到 FAQ_FAST_PATH_THRESHOLD (大於 1 代表停用)，兩者也只能相差語助詞等幾個字
+    """
+    if settings.FAQ_FAST_PATH_THRESHOLD > 1:
+        return None
+    index = get_index(agent_id, agent.get("config_version", 0), agent.get("config", {}))
+    results = index.search(query, k=1)
+    if results and results[0][0] >= settings.FAQ_FAST_PATH_THRESHOLD:
+        faq = results[0][1]
+        if is_near_verbatim(query, faq.get("question", "")):
+            return faq
+    return None
+
+def retrieve_faqs(index: FaqIndex, query: str, k: int) -> List[Dict[str, Any]]:
+    """取出與問題相關的 k 筆 FAQ；FAQ 總數不超過 k 時全部回傳 (維持原本的順序)"""
+    if len(index) <= k:
+        return index.faqs
+    return [faq for score, faq in index.search(query, k) if score > 0]
+
+def render_faq_section(agent_id: str, version: int, config: Dict[str, Any], query: str) -> str:
+    """與問題相關的 FAQ 文字"""
+    index = get_index(agent_id, version, config)
+    return format_faqs(retrieve_faqs(index, query, settings.FAQ_RETRIEVAL_TOP_K)).rstrip()
+
+def render_faq_instruction(agent_id: str, version: int, config: Dict[str, Any], query: str) -> str:
+    """組出 faq_expert 本輪的指令：只放入與問題相關的 FAQ"""
+    return FAQ_INSTRUCTION_HEADER + render_faq_section(agent_id, version, config, query) + SUBAGENT_INSTRUCTION
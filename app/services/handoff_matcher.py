@@ -0,0 +1,156 @@
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Tuple
+
+from app.services.faq_index import normalize
+
+# 商家以關鍵字設定轉接規則時，handoff_logic 的固定格式
+TRIGGER_PREFIX = "當使用者提到以下任何一項時轉接："
+
+# 判斷結果：明確提到關鍵字 / 完全無關 / 需要交給 handoff_expert 判斷
+HIT = "hit"
+MISS = "miss"
+AMBIGUOUS = "ambiguous"
+
+# 本輪訊息的判斷結果，只屬於這一則訊息，不寫入 session state
+# (由 run_chat 在執行代理前設定，handoff_expert 的 before_agent_callback 讀取)
+current_verdict: ContextVar[Optional[str]] = ContextVar("handoff_prefilter", default=None)
+
+# 關鍵字前後幾個字內出現這些字時 (例如「不要退款」、「我不想退款了」、「退款不用了」) 視為不明確
+NEGATION_CHARS = set("不沒没別别無无勿免")
+NEGATION_WINDOW_BEFORE = 4
+NEGATION_WINDOW_AFTER = 3
+
+# 超過這個長度、或本身含否定字的關鍵字視為描述性的規則 (例如自訂的一句話)，不在本地判定命中
+MAX_HIT_TRIGGER_LENGTH = 8
+
+def format_handoff_logic(triggers: List[str]) -> str:
+    if not triggers:
+        return ""
+    return f"{TRIGGER_PREFIX}{', '.join(triggers)}"
+
+def parse_triggers(handoff_logic: str) -> Optional[List[str]]:
+    """從 handoff_logic 取出關鍵字清單；不是關鍵字格式 (例如模型總結的規則) 時回傳 None"""
+    handoff_logic = (handoff_logic or "").strip()
+    if not handoff_logic.startswith(TRIGGER_PREFIX):
+        return None
+    triggers = [t.strip() for t in handoff_logic[len(TRIGGER_PREFIX):].split(",")]
+    return [t for t in triggers if t]
+
+class AhoCorasick:
+    """多關鍵字比對，一次掃描文字即可找出所有出現的關鍵字"""
+    def __init__(self, patterns: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        node = 0
+        for char in pattern:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[node][char] = nxt
+            node = nxt
+        self._output[node].append(pattern)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def find(self, text: str) -> List[Tuple[int, str]]:
+        """回傳 (開始位置, 關鍵字) 清單"""
+        found = []
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for pattern in self._output[node]:
+                found.append((i - len(pattern) + 1, pattern))
+        return found
+
+class HandoffMatcher:
+    """單一 Agent 的轉接關鍵字比對 (關鍵字與訊息都先正規化)"""
+    def __init__(self, triggers: List[str]):
+        self._original: Dict[str, str] = {}
+        for trigger in triggers:
+            key = normalize(trigger)
+            if key:
+                self._original.setdefault(key, trigger)
+        # 只有簡短明確的關鍵字可以在本地直接判定命中
+        self._automaton = AhoCorasick([
+            key for key in self._original
+            if len(key) <= MAX_HIT_TRIGGER_LENGTH and not NEGATION_CHARS.intersection(key)
+        ])
+        # 訊息與任一關鍵字有相同的兩字組合時，可能是換句話說，交給模型判斷
+        self._bigrams = {key[i:i + 2] for key in self._original for i in range(len(key) - 1)}
+
+    @staticmethod
+    def _is_negated(text: str, start: int, end: int) -> bool:
+        window = text[max(0, start - NEGATION_WINDOW_BEFORE):start] + text[end:end + NEGATION_WINDOW_AFTER]
+        return any(char in NEGATION_CHARS for char in window)
+
+    def classify(self, message: str) -> Tuple[str, Optional[str]]:
+        """
+        回傳 (判斷結果, 命中的關鍵字)
+        只有訊息原樣出現簡短關鍵字、且附近沒有否定字時才回傳 HIT
+        MISS 只代表訊息與關鍵字沒有任何相同的兩字組合，換句話說 (例如「人工客服」之於「真人」) 仍可能是 MISS
+        """
+        text = normalize(message)
+        negated = None
+        for start, key in self._automaton.find(text):
+            if self._is_negated(text, start, start + len(key)):
+                negated = negated or self._original[key]
+                continue
+            return HIT, self._original[key]
+        if negated:
+            return AMBIGUOUS, negated
+        if any(text[i:i + 2] in self._bigrams for i in range(len(text) - 1)):
+            return AMBIGUOUS, None
+        return MISS, None
+
+# agent_id -> (設定版本, HandoffMatcher)
+MAX_CACHED_MATCHERS = 512
+_MATCHERS: "OrderedDict[str, tuple]" = OrderedDict()
+
+def classify_message(agent_id: str, agent: Dict[str, Any], message: str) -> Tuple[str, Optional[str]]:
+    """
+    依商家設定的轉接關鍵字先在本地判斷是否需要轉接
+    未啟用轉接或規則不是關鍵字清單時一律回傳 AMBIGUOUS (照原本流程交給模型)
+    MISS 只有在 Agent 設定開啟 handoff_skip_on_miss 時才會回傳，否則改回傳 AMBIGUOUS 交給 handoff_expert 判斷
+    """
+    config = agent.get("config", {})
+    triggers = config.get("handoff_triggers")
+    if not config.get("enable_handoff") or not triggers:
+        return AMBIGUOUS, None
+
+    version = agent.get("config_version", 0)
+    cached = _MATCHERS.get(agent_id)
+    if cached and cached[0] == version:
+        _MATCHERS.move_to_end(agent_id)
+        matcher = cached[1]
+    else:
+        matcher = HandoffMatcher(triggers)
+        _MATCHERS[agent_id] = (version, matcher)
+        _MATCHERS.move_to_end(agent_id)
+        while len(_MATCHERS) > MAX_CACHED_MATCHERS:
+            _MATCHERS.popitem(last=False)
+    verdict, keyword = matcher.classify(message)
+    if verdict == MISS and not config.get("handoff_skip_on_miss"):
+        return AMBIGUOUS, None
+    return verdict, keyword
@@ -0,0 +1,27 @@
+"""
+將仍以 pickle 儲存的 ADK 事件 actions 改寫為 JSON 格式
+
+在 backend 目錄下執行:
+    python -m app.services.migrate_session_events --batch-size 500
+
+session service 預設不再讀取 pickle 格式 (反序列化可能執行任意程式碼)，
+仍有舊事件的資料庫請在部署前先執行。
+可在服務運作中執行，也可以重複執行 (已改寫的事件不會再處理)。
+無法解析的事件會記錄錯誤並保留原樣，不會中斷整個遷移。
+"""
+import argparse
+import asyncio
+import logging
+
+from app.services.agent_service import session_service
+
+async def migrate(batch_size: int) -> int:
+    return await session_service.migrate_pickled_events(batch_size=batch_size)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="將 pickle 格式的事件 actions 改寫為 JSON 格式")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    migrated = asyncio.run(migrate(args.batch_size))
+    print(f"已改寫 {migrated} 筆事件")
@@ -5,8 +5,8 @@ from google.genai import types
 from app.core.config import settings
 from app.models.schemas import MerchantExtraction, GeneratedFAQs, FAQPair, FAQAnalysisReport
 from app.prompts.templates import EXTRACTION_PROMPT, FAQ_GENERATION_PROMPT, FAQ_GENERATION_WITH_URL_PROMPT, FAQ_OPTIMIZE_PROMPT, FAQ_ANALYSIS_PROMPT
-from app.core.database import used_token_collection
-from app.services.usage_service import check_usage_limit, record_usage
+from app.services import usage_ledger
+from app.services.usage_service import reserve_usage
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
@@ -30,7 +30,8 @@ def build_user_summary(form_data: dict) -> str:
 
 async def generate_structure_data(form_data: dict) -> dict:
     admin_id = form_data.get("line_user_id")
-    if not await check_usage_limit(admin_id):
+    reservation = await reserve_usage(admin_id)
+    if reservation is None:
         return {"error": "已達到今日使用上限 (100次)，請明天再試。"}
 
     user_summary = build_user_summary(form_data)
@@ -61,32 +62,16 @@ async def generate_structure_data(form_data: dict) -> dict:
             "tone_avoid": form_data.get("toneAvoid", ""),
         }
 
-        usage = response.usage_metadata
-        input_token=usage.prompt_token_count
-        output_token=usage.candidates_token_count
-        thought_token=usage.thoughts_token_count or 0
-        tool_token=usage.tool_use_prompt_token_count or 0
-        
-        await used_token_collection.insert_one({
-            "chat_id": None,
-            "admin_id": form_data.get("line_user_id"),
-            "agent_id": form_data.get("agent_id"),
-            "subagent_id": None,
-            "session_id": None,
-            "model": settings.GENERAL_MODEL,
-            "usage_type": "解析表單",
-            "usage": {
-                "input_token": input_token,
-                "output_token": output_token,
-                "tool_token": tool_token,
-                "thought_token": thought_token,
-                "total_token": input_token + output_token + thought_token
-            },
-            "created_at": datetime.now(TAIPEI_TZ),
-            "input": user_summary,
-            "output": response.text
-        })
-        await record_usage(form_data.get("line_user_id"))
+        await usage_ledger.record_llm_usage(
+            response.usage_metadata,
+            usage_type="解析表單",
+            model=settings.GENERAL_MODEL,
+            admin_id=form_data.get("line_user_id"),
+            agent_id=form_data.get("agent_id"),
+            input=user_summary,
+            output=response.text
+        )
+        reservation.commit()
         return {
             "config_id": config_id,
             "merchant_name": extraction.merchant_name,
@@ -102,12 +87,16 @@ async def generate_structure_data(form_data: dict) -> dict:
     except Exception as e:
         print(f"提取失敗: {e}")
         return {"error": str(e)}
+    finally:
+        reservation.release()
 
 def get_cached_logic(config_id: str) -> dict:
     return PENDING_CONFIG_CACHE.get(config_id)
 
 async def generate_faqs(brand_description: str, website_url: str, line_user_id: Optional[str] = None) -> dict:
-    if not await check_usage_limit(line_user_id):
+    # 提供網站時會呼叫兩次模型，一次預留兩次額度
+    reservation = await reserve_usage(line_user_id, 2 if website_url else 1)
+    if reservation is None:
         return {"error": "已達到今日使用上限 (100次)，請明天再試。"}
     try:
         website_text = "未提供"
@@ -125,32 +114,15 @@ async def generate_faqs(brand_description: str, website_url: str, line_user_id:
             print("website_text", website_text)
 
             # 記錄爬取網頁的 Token 消耗
-            w_usage = website_response.usage_metadata
-            w_input = w_usage.prompt_token_count
-            w_output = w_usage.candidates_token_count
-            w_thought = w_usage.thoughts_token_count or 0
-            w_tool = w_usage.tool_use_prompt_token_count or 0
-            
-            await used_token_collection.insert_one({
-                "chat_id": None,
-                "admin_id": line_user_id,
-                "agent_id": None,
-                "subagent_id": None,
-                "session_id": None,
-                "model": settings.GENERAL_MODEL,
-                "usage_type": "爬取商家網站",
-                "usage": {
-                    "input_token": w_input,
-                    "output_token": w_output,
-                    "tool_token": w_tool,
-                    "thought_token": w_thought,
-                    "total_token": w_input + w_output + w_tool + w_thought
-                },
-                "created_at": datetime.now(TAIPEI_TZ),
-                "input": f"完整提取並回傳這個 url 的所有原始內容文字: URL: {website_url}",
-                "output": website_response.text
-            })
-            await record_usage(line_user_id)
+            await usage_ledger.record_llm_usage(
+                website_response.usage_metadata,
+                usage_type="爬取商家網站",
+                model=settings.GENERAL_MODEL,
+                admin_id=line_user_id,
+                input=f"完整提取並回傳這個 url 的所有原始內容文字: URL: {website_url}",
+                output=website_response.text
+            )
+            reservation.commit()
 
             prompt = FAQ_GENERATION_WITH_URL_PROMPT.format(
                 merchant_info=brand_description,
@@ -171,40 +143,26 @@ async def generate_faqs(brand_description: str, website_url: str, line_user_id:
         )
         
         # 記錄生成 FAQ 的 Token 消耗
-        f_usage = response.usage_metadata
-        f_input = f_usage.prompt_token_count
-        f_output = f_usage.candidates_token_count
-        f_thought = f_usage.thoughts_token_count or 0
-        f_tool = f_usage.tool_use_prompt_token_count or 0
-        
-        await used_token_collection.insert_one({
-            "chat_id": None,
-            "admin_id": line_user_id,
-            "agent_id": None,
-            "subagent_id": None,
-            "session_id": None,
-            "model": settings.GENERAL_MODEL,
-            "usage_type": "生成 FAQ",
-            "usage": {
-                "input_token": f_input,
-                "output_token": f_output,
-                "tool_token": f_tool,
-                "thought_token": f_thought,
-                "total_token": f_input + f_output + f_tool + f_thought
-            },
-            "created_at": datetime.now(TAIPEI_TZ),
-            "input": prompt,
-            "output": response.text
-        })
+        await usage_ledger.record_llm_usage(
+            response.usage_metadata,
+            usage_type="生成 FAQ",
+            model=settings.GENERAL_MODEL,
+            admin_id=line_user_id,
+            input=prompt,
+            output=response.text
+        )
 
-        await record_usage(line_user_id)
+        reservation.commit()
         return GeneratedFAQs.model_validate_json(response.text).model_dump()
     except Exception as e:
         print(f"FAQ 生成失敗: {e}")
         return {"error": str(e)}
+    finally:
+        reservation.release()
 
 async def optimize_faq(question: str, answer: str, line_user_id: Optional[str] = None) -> dict:
-    if not await check_usage_limit(line_user_id):
+    reservation = await reserve_usage(line_user_id)
+    if reservation is None:
         return {"error": "已達到今日使用上限 (100次)，請明天再試。"}
     try:
         prompt = FAQ_OPTIMIZE_PROMPT.format(
@@ -222,40 +180,26 @@ async def optimize_faq(question: str, answer: str, line_user_id: Optional[str] =
         )
         
         # 記錄優化 FAQ 的 Token 消耗
-        usage = response.usage_metadata
-        u_input = usage.prompt_token_count
-        u_output = usage.candidates_token_count
-        u_thought = usage.thoughts_token_count or 0
-        u_tool = usage.tool_use_prompt_token_count or 0
-        
-        await used_token_collection.insert_one({
-            "chat_id": None,
-            "admin_id": line_user_id,
-            "agent_id": None,
-            "subagent_id": None,
-            "session_id": None,
-            "model": settings.GENERAL_MODEL,
-            "usage_type": "優化 FAQ",
-            "usage": {
-                "input_token": u_input,
-                "output_token": u_output,
-                "tool_token": u_tool,
-                "thought_token": u_thought,
-                "total_token": u_input + u_output + u_tool + u_thought
-            },
-            "created_at": datetime.now(TAIPEI_TZ),
-            "input": prompt,
-            "output": response.text
-        })
-        await record_usage(line_user_id)
+        await usage_ledger.record_llm_usage(
+            response.usage_metadata,
+            usage_type="優化 FAQ",
+            model=settings.GENERAL_MODEL,
+            admin_id=line_user_id,
+            input=prompt,
+            output=response.text
+        )
+        reservation.commit()
 
         return FAQPair.model_validate_json(response.text).model_dump()
     except Exception as e:
         print(f"FAQ 優化失敗: {e}")
         return {"error": str(e)}
+    finally:
+        reservation.release()
 
 async def analyze_faqs(brand_description: str, faqs: list, line_user_id: Optional[str] = None) -> dict:
-    if not await check_usage_limit(line_user_id):
+    reservation = await reserve_usage(line_user_id)
+    if reservation is None:
         return {"error": "已達到今日使用上限 (100次)，請明天再試。"}
     try:
         import json
@@ -276,34 +220,19 @@ async def analyze_faqs(brand_description: str, faqs: list, line_user_id: Optiona
         )
         
         # 記錄健檢 FAQ 的 Token 消耗
-        usage = response.usage_metadata
-        a_input = usage.prompt_token_count
-        a_output = usage.candidates_token_count
-        a_thought = usage.thoughts_token_count or 0
-        a_tool = usage.tool_use_prompt_token_count or 0
-        
-        await used_token_collection.insert_one({
-            "chat_id": None,
-            "admin_id": line_user_id,
-            "agent_id": None,
-            "subagent_id": None,
-            "session_id": None,
-            "model": settings.GENERAL_MODEL,
-            "usage_type": "AI 健檢 FAQ",
-            "usage": {
-                "input_token": a_input,
-                "output_token": a_output,
-                "tool_token": a_tool,
-                "thought_token": a_thought,
-                "total_token": a_input + a_output + a_tool + a_thought
-            },
-            "created_at": datetime.now(TAIPEI_TZ),
-            "input": prompt,
-            "output": response.text
-        })
-        await record_usage(line_user_id)
+        await usage_ledger.record_llm_usage(
+            response.usage_metadata,
+            usage_type="AI 健檢 FAQ",
+            model=settings.GENERAL_MODEL,
+            admin_id=line_user_id,
+            input=prompt,
+            output=response.text
+        )
+        reservation.commit()
         
         return FAQAnalysisReport.model_validate_json(response.text).model_dump()
     except Exception as e:
         print(f"FAQ 健檢失敗: {e}")
         return {"error": str(e)}
+    finally:
+        reservation.release()
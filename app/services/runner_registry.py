@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from typing import Dict, Any
+
+from google.adk import Runner
+from google.adk.sessions import BaseSessionService
+
+from app.core.config import settings
+from app.agents.bot_agents import build_configured_agent
+
+# agent_id -> (設定版本, Runner)；每個 Agent 只保留目前版本，設定更新後舊的 Runner 會被取代
+_RUNNERS: "OrderedDict[str, tuple]" = OrderedDict()
+
+def get_runner(agent_id: str, agent: Dict[str, Any], session_service: BaseSessionService) -> Runner:
+    """
+    取得該 Agent 目前設定版本的 Runner (指令已解析完成，不需每輪對話重新建立)
+    :param agent: Agent 文件 (需包含 config)
+    """
+    version = agent.get("config_version", 0)
+    cached = _RUNNERS.get(agent_id)
+    if cached and cached[0] == version:
+        _RUNNERS.move_to_end(agent_id)
+        return cached[1]
+
+    runner = Runner(
+        agent=build_configured_agent(agent_id, version, agent["config"]),
+        app_name=f"agent_{agent_id}",
+        session_service=session_service
+    )
+    _RUNNERS[agent_id] = (version, runner)
+    _RUNNERS.move_to_end(agent_id)
+    while len(_RUNNERS) > settings.RUNNER_CACHE_MAX_SIZE:
+        _RUNNERS.popitem(last=False)
+    return runner
+
+def invalidate(agent_id: str):
+    """Agent 設定更新後呼叫，讓下次對話以新設定建立 Runner"""
+    _RUNNERS.pop(str(agent_id), None)
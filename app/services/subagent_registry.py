@@ -0,0 +1,66 @@
+import asyncio
+from typing import Optional, Dict, Any, List
+
+from app.core.config import settings
+from app.core.database import subagent_collection
+
+# 官方 subagent 幾乎不變動，啟動時載入一次，之後定時或由管理者手動刷新
+_BY_ID: Dict[str, Dict[str, Any]] = {}
+_BY_NAME: Dict[str, Dict[str, Any]] = {}
+_loaded = False
+_refresh_task: Optional[asyncio.Task] = None
+
+async def refresh():
+    """從 subagent_collection 重新載入所有 subagent"""
+    global _BY_ID, _BY_NAME, _loaded
+    by_id = {}
+    by_name = {}
+    async for sa in subagent_collection.find({}):
+        sa["_id"] = str(sa["_id"])
+        by_id[sa["_id"]] = sa
+        by_name[sa["name"]] = sa
+    # 整批替換，讀取端不會看到載入到一半的資料
+    _BY_ID, _BY_NAME = by_id, by_name
+    _loaded = True
+
+async def ensure_loaded():
+    if not _loaded:
+        await refresh()
+
+def get_id(name: str) -> Optional[str]:
+    """依名稱取得 subagent id (例如 "Knowledge Base")"""
+    sa = _BY_NAME.get(name)
+    return sa["_id"] if sa else None
+
+def get_by_id(subagent_id: str) -> Optional[Dict[str, Any]]:
+    """回傳 subagent 文件的副本 (可安全修改)"""
+    sa = _BY_ID.get(subagent_id)
+    return dict(sa) if sa else None
+
+def list_all() -> List[Dict[str, Any]]:
+    return [dict(sa) for sa in _BY_ID.values()]
+
+def get_title(subagent_id: str) -> Optional[str]:
+    sa = _BY_ID.get(subagent_id)
+    return sa.get("title") if sa else None
+
+async def _refresh_loop(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh()
+        except Exception as e:
+            print(f"Subagent registry 刷新失敗: {e}")
+
+async def start():
+    """啟動時載入並開始定時刷新"""
+    global _refresh_task
+    await refresh()
+    if _refresh_task is None and settings.SUBAGENT_REFRESH_SECONDS > 0:
+        _refresh_task = asyncio.create_task(_refresh_loop(settings.SUBAGENT_REFRESH_SECONDS))
+
+async def stop():
+    global _refresh_task
+    if _refresh_task:
+        _refresh_task.cancel()
+        _refresh_task = None
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Optional, Dict, Any, List
+from pymongo.errors import BulkWriteError
+
+from app.core.config import settings
+
+# 對話紀錄的背景寫入佇列：回覆送出後才寫入資料庫，不增加使用者等待時間
+# 單一 worker 依序處理，因此同一 session 的寫入順序與加入佇列的順序一致
+_queue: Optional[asyncio.Queue] = None
+_worker: Optional[asyncio.Task] = None
+_STOP = object()
+
+MAX_RETRIES = 5
+
+async def _insert_with_retry(collection, docs: List[Dict[str, Any]]):
+    attempt = 0
+    while docs:
+        try:
+            await collection.insert_many(docs, ordered=True)
+            return
+        except BulkWriteError as e:
+            inserted = e.details.get("nInserted", 0)
+            errors = e.details.get("writeErrors", [])
+            if errors and errors[0].get("code") == 11000:
+                # 前一次重試其實已寫入成功，略過該筆繼續寫入剩下的
+                docs = docs[inserted + 1:]
+                continue
+            docs = docs[inserted:]
+            error = e
+        except Exception as e:
+            error = e
+        attempt += 1
+        if attempt > MAX_RETRIES:
+            print(f"對話紀錄寫入失敗，已放棄 {len(docs)} 筆 ({collection.name}): {error}")
+            return
+        await asyncio.sleep(min(2 ** attempt * 0.1, 5))
+
+async def _flush(batch: list):
+    # 依 collection 合併成 insert_many，同一 collection 內維持加入佇列的順序
+    docs_by_collection: Dict[Any, List[Dict[str, Any]]] = {}
+    for collection, document in batch:
+        docs_by_collection.setdefault(collection, []).append(document)
+    for collection, docs in docs_by_collection.items():
+        await _insert_with_retry(collection, docs)
+
+async def _worker_loop():
+    while True:
+        item = await _queue.get()
+        taken = 1
+        batch = []
+        stopping = item is _STOP
+        if not stopping:
+            batch.append(item)
+        # 一次取出目前佇列中的資料 (最多 batch size 筆) 合併寫入
+        while not stopping and len(batch) < settings.TRANSCRIPT_BATCH_SIZE and not _queue.empty():
+            item = _queue.get_nowait()
+            taken += 1
+            if item is _STOP:
+                stopping = True
+            else:
+                batch.append(item)
+        try:
+            if batch:
+                await _flush(batch)
+        finally:
+            for _ in range(taken):
+                _queue.task_done()
+        if stopping:
+            return
+
+async def _put(item: tuple):
+    if _worker is None or _worker.done():
+        # 沒有啟動背景 worker 時 (例如單獨執行的腳本) 直接寫入
+        await _flush([item])
+        return
+    # 佇列已滿時在此等待，避免記憶體無限成長
+    await _queue.put(item)
+
+async def enqueue_insert(collection, document: Dict[str, Any]):
+    """加入一筆背景寫入的文件 (document 需自行帶入 _id 以便其他紀錄引用)"""
+    await _put((collection, document))
+
+def pending() -> int:
+    """目前等待寫入的筆數"""
+    return _queue.qsize() if _worker is not None else 0
+
+async def flush():
+    """等待目前佇列中的資料全部寫入"""
+    if _worker is not None and not _worker.done():
+        await _queue.join()
+
+def start():
+    global _queue, _worker
+    if _worker is None:
+        _queue = asyncio.Queue(maxsize=settings.TRANSCRIPT_QUEUE_SIZE)
+        _worker = asyncio.create_task(_worker_loop())
+
+async def stop():
+    """關閉時寫完佇列中所有資料"""
+    global _worker
+    if _worker is not None:
+        await _queue.put(_STOP)
+        await _worker
+        _worker = None
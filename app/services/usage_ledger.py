@@ -0,0 +1,65 @@
+from datetime import datetime
+from typing import Optional, Dict, Any
+from zoneinfo import ZoneInfo
+from bson import ObjectId
+
+from app.core.database import used_token_collection
+from app.services import transcript_writer
+
+TAIPEI_TZ = ZoneInfo("Asia/Taipei")
+
+def usage_from_metadata(usage_metadata: Any) -> Dict[str, int]:
+    """將模型回傳的 usage_metadata 轉為 used_token 紀錄的 usage 欄位 (total 一律為各項加總)"""
+    input_token = getattr(usage_metadata, "prompt_token_count", None) or 0
+    output_token = getattr(usage_metadata, "candidates_token_count", None) or 0
+    tool_token = getattr(usage_metadata, "tool_use_prompt_token_count", None) or 0
+    thought_token = getattr(usage_metadata, "thoughts_token_count", None) or 0
+    return {
+        "input_token": input_token,
+        "output_token": output_token,
+        "tool_token": tool_token,
+        "thought_token": thought_token,
+        "total_token": input_token + output_token + tool_token + thought_token
+    }
+
+async def record_llm_usage(
+    usage_metadata: Any,
+    *,
+    usage_type: str,
+    model: str,
+    admin_id: Optional[str],
+    input: Optional[str] = None,
+    output: Optional[str] = None,
+    agent_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    chat_id: Optional[str] = None,
+    subagent_id: Any = None,
+):
+    """
+    記錄一次 LLM 呼叫的 token 消耗
+    紀錄先進入背景寫入佇列，批次寫入 used_token_collection；需要立即寫入時呼叫 flush()
+    """
+    if usage_metadata is None:
+        return
+    await transcript_writer.enqueue_insert(used_token_collection, {
+        "_id": ObjectId(),
+        "chat_id": chat_id,
+        "admin_id": admin_id,
+        "agent_id": agent_id,
+        "subagent_id": subagent_id,
+        "session_id": session_id,
+        "model": model,
+        "usage_type": usage_type,
+        "usage": usage_from_metadata(usage_metadata),
+        "created_at": datetime.now(TAIPEI_TZ),
+        "input": input,
+        "output": output
+    })
+
+async def flush():
+    """等待所有已記錄的用量寫入資料庫"""
+    await transcript_writer.flush()
+
+def pending() -> int:
+    """尚未寫入的紀錄數 (佇列已滿時 record_llm_usage 會等待)"""
+    return transcript_writer.pending()
@@ -1,44 +1,158 @@
+import asyncio
 from datetime import datetime
 from zoneinfo import ZoneInfo
+from pymongo import ReturnDocument
+from app.core.config import settings
 from app.core.database import daily_usage_collection
-from typing import Optional
+from typing import Optional, Dict, Tuple
 
 TAIPEI_TZ = ZoneInfo("Asia/Taipei")
 DAILY_LIMIT = 100
 
-async def check_usage_limit(admin_id: str) -> bool:
+# 每位管理員每日的使用量計數器，保存在記憶體中
+# 檢查與預留在同一個 event loop 步驟內完成 (中間沒有 await)，因此同一個 process 內的並行請求不會超過上限
+# 已使用但尚未寫回的量 (unsynced) 由背景工作定時以 $inc 寫入 daily_usage_collection，並同步其他 worker 的用量
+class _Counter:
+    def __init__(self, used: int):
+        self.used = used
+        self.reserved = 0
+        self.unsynced = 0
+
+_counters: Dict[Tuple[str, str], _Counter] = {}
+_load_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+_reconcile_task: Optional[asyncio.Task] = None
+_sync_tasks: set = set()
+
+def _today() -> str:
+    return datetime.now(TAIPEI_TZ).strftime("%Y-%m-%d")
+
+async def _get_counter(admin_id: str, date: str) -> _Counter:
+    key = (admin_id, date)
+    counter = _counters.get(key)
+    if counter is not None:
+        return counter
+    lock = _load_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        counter = _counters.get(key)
+        if counter is None:
+            # 每個 process 每位管理員每天只需讀取一次
+            usage_doc = await daily_usage_collection.find_one({"admin_id": admin_id, "date": date})
+            counter = _Counter(usage_doc.get("usage", 0) if usage_doc else 0)
+            _counters[key] = counter
+    _load_locks.pop(key, None)
+    return counter
+
+class UsageReservation:
+    """預留的使用量：成功後 commit，失敗或未使用時 release (皆可重複呼叫)"""
+    def __init__(self, admin_id: Optional[str], date: str, amount: int):
+        self.admin_id = admin_id
+        self.date = date
+        self.remaining = amount
+
+    def commit(self, amount: int = 1):
+        """將預留量轉為實際使用量"""
+        amount = min(amount, self.remaining)
+        if not self.admin_id or amount <= 0:
+            return
+        counter = _counters[(self.admin_id, self.date)]
+        counter.reserved -= amount
+        counter.used += amount
+        counter.unsynced += amount
+        self.remaining -= amount
+        if _reconcile_task is None:
+            # 沒有啟動定時同步時 (例如單獨執行的腳本) 直接寫回
+            task = asyncio.create_task(_sync((self.admin_id, self.date)))
+            _sync_tasks.add(task)
+            task.add_done_callback(_sync_tasks.discard)
+
+    def release(self):
+        """釋放尚未使用的預留量"""
+        if self.admin_id and self.remaining > 0:
+            _counters[(self.admin_id, self.date)].reserved -= self.remaining
+        self.remaining = 0
+
+async def reserve_usage(admin_id: Optional[str], amount: int = 1) -> Optional[UsageReservation]:
     """
-    檢查該管理員是否已達今日使用上限
+    預留使用量，已達今日上限時回傳 None
+    沒有 admin_id (可能是測試或未登入) 時不限制
     """
+    date = _today()
     if not admin_id:
-        return True # 如果沒有 admin_id (可能是測試或未登入)，暫時不限制 or 根據需求調整
-        
-    today_str = datetime.now(TAIPEI_TZ).strftime("%Y-%m-%d")
-    
-    usage_doc = await daily_usage_collection.find_one({
-        "admin_id": admin_id,
-        "date": today_str
-    })
-    
-    if usage_doc and usage_doc.get("usage", 0) >= DAILY_LIMIT:
-        return False
-    
-    return True
-
-async def record_usage(admin_id: str):
+        return UsageReservation(None, date, amount)
+    counter = await _get_counter(admin_id, date)
+    if counter.used + counter.reserved + amount > DAILY_LIMIT:
+        return None
+    counter.reserved += amount
+    return UsageReservation(admin_id, date, amount)
+
+async def get_usage_count(admin_id: str) -> int:
     """
-    記錄一次使用量
+    取得今日已使用次數 (資料庫中所有 worker 已寫回的量，加上本 process 尚未寫回的量)
     """
     if not admin_id:
+        return 0
+    date = _today()
+    usage_doc = await daily_usage_collection.find_one({"admin_id": admin_id, "date": date})
+    total = usage_doc.get("usage", 0) if usage_doc else 0
+    counter = _counters.get((admin_id, date))
+    if counter is not None:
+        total += counter.unsynced
+        counter.used = max(counter.used, total)
+    return total
+
+async def _sync(key: Tuple[str, str]):
+    """將尚未寫回的使用量以 $inc 寫入資料庫，並取回包含其他 worker 的最新總量"""
+    counter = _counters.get(key)
+    if counter is None:
         return
-        
-    today_str = datetime.now(TAIPEI_TZ).strftime("%Y-%m-%d")
-    
-    await daily_usage_collection.update_one(
-        {"admin_id": admin_id, "date": today_str},
-        {
-            "$inc": {"usage": 1},
-            "$set": {"updated_at": datetime.now(TAIPEI_TZ)}
-        },
-        upsert=True
-    )
+    amount = counter.unsynced
+    counter.unsynced -= amount
+    admin_id, date = key
+    try:
+        if amount > 0:
+            usage_doc = await daily_usage_collection.find_one_and_update(
+                {"admin_id": admin_id, "date": date},
+                {
+                    "$inc": {"usage": amount},
+                    "$set": {"updated_at": datetime.now(TAIPEI_TZ)}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        else:
+            # 沒有需要寫回的量時仍讀取資料庫總量，取得其他 worker 的用量
+            usage_doc = await daily_usage_collection.find_one({"admin_id": admin_id, "date": date})
+    except Exception as e:
+        counter.unsynced += amount
+        print(f"使用量同步失敗 ({admin_id} {date}): {e}")
+        return
+    # 資料庫總量 = 所有 worker 已寫回的量；加上本地尚未寫回的量即為目前總量
+    db_usage = usage_doc.get("usage", 0) if usage_doc else 0
+    counter.used = max(counter.used, db_usage + counter.unsynced)
+
+async def reconcile():
+    """同步所有計數器，並清除過期日期的計數器"""
+    today = _today()
+    for key in list(_counters.keys()):
+        await _sync(key)
+        counter = _counters.get(key)
+        if key[1] != today and counter and counter.unsynced == 0 and counter.reserved == 0:
+            del _counters[key]
+
+async def _reconcile_loop(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        await reconcile()
+
+def start():
+    global _reconcile_task
+    if _reconcile_task is None:
+        _reconcile_task = asyncio.create_task(_reconcile_loop(settings.USAGE_SYNC_SECONDS))
+
+async def stop():
+    """關閉時寫回所有尚未同步的使用量"""
+    global _reconcile_task
+    if _reconcile_task is not None:
+        _reconcile_task.cancel()
+        _reconcile_task = None
+    await reconcile()